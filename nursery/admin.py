@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Plant, PlantInstance, Location
+from .models import Plant, PlantInstance, Location, Task
 
 #admin.site.register(Plant)
 #admin.site.register(PlantInstance)
@@ -16,7 +16,7 @@ class PlantInstanceInline(admin.StackedInline):
 class PlantAdmin(admin.ModelAdmin):
     list_display = ('scientific_name', 'common_name', 'water', 'sun', 'description', 'care_tips', 'user')
     list_filter = ('user', 'scientific_name')
-    fields = ['user', ('scientific_name', 'common_name'), ('water', 'sun'), 'description', 'care_tips']
+    fields = ['user', ('scientific_name', 'common_name'), ('water', 'sun'), 'description', 'care_tips', 'image']
 
     inlines = [PlantInstanceInline]
 
@@ -26,7 +26,7 @@ class PlantInstanceAdmin(admin.ModelAdmin):
     list_display = ('nickname', 'plant', 'display_common_name', 'customer','location', 'due_watered')
     list_filter = ('due_watered',)
 
-    fields = ['plant', 'nickname', 'location', 'customer', ('purchased', 'due_watered'), 'id']
+    fields = ['plant', 'nickname', 'location', 'customer', ('purchased', 'due_watered'), 'image', 'id']
     readonly_fields = ['id']
 
 # Register the Admin classes for Location using the decorator
@@ -36,4 +36,11 @@ class LocationAdmin(admin.ModelAdmin):
     list_filter = ('name', 'user')
     fields = ['name', 'user']
 
-    inlines = [PlantInstanceInline]
\ No newline at end of file
+    inlines = [PlantInstanceInline]
+
+# Register the Admin classes for Task using the decorator
+@admin.register(Task)
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ('name', 'status', 'priority', 'attempts', 'max_attempts', 'available_at', 'locked_by', 'finished')
+    list_filter = ('status', 'name')
+    readonly_fields = ['attempts', 'locked_until', 'locked_by', 'last_error', 'created', 'finished']
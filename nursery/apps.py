@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class NurseryConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'nursery'
+
+    def ready(self):
+        # Connect the cache invalidation signal handlers, and the query counter used by
+        # MetricsMiddleware (before any database connection is opened)
+        from . import middleware, signals
@@ -0,0 +1,75 @@
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core import checks
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from .cache_versions import bump_version, get_versions
+from .metrics import CACHE_REQUESTS
+
+# Version keys are bumped by nursery.signals whenever permissions change. Bumping a
+# user's version (or the global one, for group-wide changes) makes old entries unreachable.
+GLOBAL_VERSION_KEY = 'perms:version'
+USER_VERSION_KEY = 'perms:version:{}'
+
+
+def permission_cache():
+    return caches[getattr(settings, 'PERMISSION_CACHE_ALIAS', 'default')]
+
+
+def invalidate_user_permissions(user_id):
+    bump_version(permission_cache(), USER_VERSION_KEY.format(user_id))
+
+
+def invalidate_all_permissions():
+    bump_version(permission_cache(), GLOBAL_VERSION_KEY)
+
+
+@checks.register(checks.Tags.caches)
+def check_permission_cache(app_configs, **kwargs):
+    """Refuses a permission cache that isn't shared between worker processes.
+
+    Invalidation only reaches the process that made the change, so with a per-process cache
+    other workers would keep granting revoked permissions until PERMISSION_CACHE_TIMEOUT.
+    """
+    if 'nursery.backends.CachedModelBackend' not in settings.AUTHENTICATION_BACKENDS:
+        return []
+    if isinstance(permission_cache(), (LocMemCache, DummyCache)):
+        return [checks.Error(
+            'CachedModelBackend needs a cache shared by every worker process.',
+            hint="Point PERMISSION_CACHE_ALIAS at a file, database, Redis or Memcached cache in CACHES.",
+            id='nursery.E001',
+        )]
+    return []
+
+
+class CachedModelBackend(ModelBackend):
+    """ModelBackend that keeps each user's permission sets in the cache between requests."""
+
+    def _get_cached_permissions(self, user_obj):
+        # Within a request, keep using what was loaded for this user object.
+        if not hasattr(user_obj, '_shared_perm_cache'):
+            cache = permission_cache()
+            user_version_key = USER_VERSION_KEY.format(user_obj.pk)
+            versions = get_versions(cache, [GLOBAL_VERSION_KEY, user_version_key])
+            key = 'perms:{}:{}:{}'.format(user_obj.pk, versions[GLOBAL_VERSION_KEY], versions[user_version_key])
+            perms = cache.get(key)
+            CACHE_REQUESTS.inc(cache='permissions', result='miss' if perms is None else 'hit')
+            if perms is None:
+                perms = {
+                    'user': super().get_user_permissions(user_obj),
+                    'group': super().get_group_permissions(user_obj),
+                }
+                cache.set(key, perms, getattr(settings, 'PERMISSION_CACHE_TIMEOUT', 3600))
+            user_obj._shared_perm_cache = perms
+        return user_obj._shared_perm_cache
+
+    def get_user_permissions(self, user_obj, obj=None):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        return self._get_cached_permissions(user_obj)['user']
+
+    def get_group_permissions(self, user_obj, obj=None):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        return self._get_cached_permissions(user_obj)['group']
@@ -0,0 +1,119 @@
+"""Set-based bulk operations used by the staff bulk views.
+
+Each operation runs in one transaction: it checks for conflicts first, then (unless dry_run
+is set or conflicts were found) applies its changes with a few UPDATE/DELETE statements.
+Updates bump the rows' version so open edit forms notice the change (see VersionedModel).
+Every operation returns a dict with 'counts', 'conflicts' and 'applied'.
+"""
+from django.db import transaction
+from django.db.models import Count, F
+from .dashboard import invalidate_location_dashboard
+from .events import publish
+from .models import Location, Plant, PlantInstance
+from .signals import per_row_notifications_paused
+
+
+def _result(counts, conflicts, applied):
+    return {'counts': counts, 'conflicts': conflicts, 'applied': applied}
+
+
+def _notify_owners_on_commit(user_ids):
+    # update() doesn't go through the per-object signal handlers
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+
+    def notify():
+        for user_id in user_ids:
+            invalidate_location_dashboard(user_id)
+            publish(user_id, 'refresh')
+    transaction.on_commit(notify)
+
+
+@transaction.atomic
+def move_plant_instances(from_location, to_location, dry_run=False):
+    """Moves every plant instance in from_location to to_location.
+
+    Plant instances whose customer doesn't own to_location are reported as conflicts.
+    """
+    instances = PlantInstance.objects.filter(location=from_location)
+    conflicts = [
+        f'{nickname} belongs to {customer or "nobody"}, but {to_location} belongs to {to_location.user}'
+        for nickname, customer in
+        instances.exclude(customer=to_location.user).values_list('nickname', 'customer__username')
+    ] if to_location.user_id else []
+    counts = {'plant instances': instances.count()}
+    if dry_run or conflicts:
+        return _result(counts, conflicts, False)
+
+    _notify_owners_on_commit(instances.values_list('customer_id', flat=True).distinct())
+    counts['plant instances'] = instances.update(location=to_location, version=F('version') + 1)
+    return _result(counts, conflicts, True)
+
+
+@transaction.atomic
+def reassign_garden(from_user, to_user, dry_run=False):
+    """Transfers every location, plant and plant instance owned by from_user to to_user.
+
+    Names that to_user already uses would break the per-owner unique constraints, so they
+    are reported as conflicts and nothing is changed.
+    """
+    locations = Location.objects.filter(user=from_user)
+    plants = Plant.objects.filter(user=from_user)
+    instances = PlantInstance.objects.filter(customer=from_user)
+
+    conflicts = [
+        f'{to_user} already has a location named {name}' for name in
+        locations.filter(name__in=Location.objects.filter(user=to_user).values('name'))
+        .values_list('name', flat=True)
+    ] + [
+        f'{to_user} already has a plant {name}' for name in
+        plants.filter(scientific_name__in=Plant.objects.filter(user=to_user).values('scientific_name'))
+        .values_list('scientific_name', flat=True)
+    ] + [
+        f'{to_user} already has a plant nicknamed {name}' for name in
+        instances.filter(nickname__in=PlantInstance.objects.filter(customer=to_user).values('nickname'))
+        .values_list('nickname', flat=True)
+    ]
+    counts = {'locations': locations.count(), 'plants': plants.count(), 'plant instances': instances.count()}
+    if dry_run or conflicts:
+        return _result(counts, conflicts, False)
+
+    counts['locations'] = locations.update(user=to_user, version=F('version') + 1)
+    counts['plants'] = plants.update(user=to_user, version=F('version') + 1)
+    counts['plant instances'] = instances.update(customer=to_user, version=F('version') + 1)
+    _notify_owners_on_commit([from_user.pk, to_user.pk])
+    return _result(counts, conflicts, True)
+
+
+@transaction.atomic
+def delete_objects(plant_instances, locations, plants, dry_run=False):
+    """Deletes the plant instances, then the locations and plants, of the given querysets.
+
+    Locations and plants are protected by on_delete=RESTRICT, so any that would still hold
+    plant instances after the instances above are removed are reported as conflicts.
+    """
+    instances = plant_instances
+    remaining = PlantInstance.objects.exclude(id__in=instances.values('id'))
+
+    conflicts = [
+        f'location {name} still has {count} plant instance(s)' for name, count in
+        locations.filter(plantinstance__in=remaining)
+        .values_list('name').annotate(count=Count('plantinstance'))
+    ] + [
+        f'plant {name} still has {count} plant instance(s)' for name, count in
+        plants.filter(plantinstance__in=remaining)
+        .values_list('scientific_name').annotate(count=Count('plantinstance'))
+    ]
+    counts = {'plant instances': instances.count(), 'locations': locations.count(), 'plants': plants.count()}
+    if dry_run or conflicts:
+        return _result(counts, conflicts, False)
+
+    _notify_owners_on_commit(
+        list(instances.values_list('customer_id', flat=True).distinct())
+        + list(locations.values_list('user_id', flat=True))
+    )
+    # delete() still sends post_delete per row (e.g. to remove photo files)
+    with per_row_notifications_paused():
+        counts['plant instances'] = instances.delete()[0]
+        counts['locations'] = locations.delete()[0]
+        counts['plants'] = plants.delete()[0]
+    return _result(counts, conflicts, True)
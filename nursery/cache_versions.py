@@ -0,0 +1,34 @@
+"""Version counters for invalidating groups of cache entries at once.
+
+Cached entries include the current value of one or more version keys in their own key;
+bumping a version makes every entry built with the old value unreachable. A version that
+is missing (never set, or evicted) is recreated from the clock rather than reset to a
+fixed value, so it can't come back to a value that old entries were stored under.
+"""
+import time
+
+
+def _new_version():
+    return time.time_ns()
+
+
+def get_versions(cache, keys):
+    """Returns {key: version} for the given version keys, creating any that are missing."""
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    for key in missing:
+        cache.add(key, _new_version(), timeout=None)
+    if missing:
+        # another process may have created the key first; use whichever value won
+        versions.update(cache.get_many(missing))
+    return versions
+
+
+def bump_version(cache, key):
+    """Increments a version counter, creating it if it doesn't exist yet."""
+    if not cache.add(key, _new_version(), timeout=None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            # evicted between add() and incr()
+            cache.set(key, _new_version(), timeout=None)
@@ -0,0 +1,48 @@
+import datetime
+from django.core.cache import cache
+from django.db.models import Count, Q
+from .cache_versions import bump_version, get_versions
+from .metrics import CACHE_REQUESTS
+from .models import Location
+
+# Bumped by nursery.signals whenever one of the user's plant instances or locations changes.
+VERSION_KEY = 'location-dashboard:version:{}'
+CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def invalidate_location_dashboard(user_id):
+    """Makes the next location_dashboard() call for this user recompute its counts."""
+    bump_version(cache, VERSION_KEY.format(user_id))
+
+
+def location_dashboard(user):
+    """Returns, for each of the user's locations, plant instance counts bucketed by due watered date.
+
+    Buckets are overdue (before today), due today, due in 1-3 days and due in 4-7 days.
+    Counts come from a single grouped query and are cached until the user's plants change
+    (or the date rolls over).
+    """
+    today = datetime.date.today()
+    version_key = VERSION_KEY.format(user.pk)
+    key = 'location-dashboard:{}:{}:{}'.format(user.pk, get_versions(cache, [version_key])[version_key], today)
+    rows = cache.get(key)
+    CACHE_REQUESTS.inc(cache='location-dashboard', result='miss' if rows is None else 'hit')
+    if rows is None:
+        # only count plants owned by the location's user, as LocationDetailView does
+        owned = Q(plantinstance__customer=user)
+        in_3_days = (today + datetime.timedelta(days=1), today + datetime.timedelta(days=3))
+        in_7_days = (today + datetime.timedelta(days=4), today + datetime.timedelta(days=7))
+        rows = list(
+            Location.objects.filter(user=user)
+            .values('id', 'name')
+            .annotate(
+                total=Count('plantinstance', filter=owned),
+                overdue=Count('plantinstance', filter=owned & Q(plantinstance__due_watered__lt=today)),
+                due_today=Count('plantinstance', filter=owned & Q(plantinstance__due_watered=today)),
+                due_3_days=Count('plantinstance', filter=owned & Q(plantinstance__due_watered__range=in_3_days)),
+                due_7_days=Count('plantinstance', filter=owned & Q(plantinstance__due_watered__range=in_7_days)),
+            )
+            .order_by('name')
+        )
+        cache.set(key, rows, CACHE_TIMEOUT)
+    return rows
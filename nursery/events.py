@@ -0,0 +1,132 @@
+"""Live plant instance events for the Server-Sent Events stream (see views.watering_events).
+
+Model signals and bulk operations call publish(); every open stream of that user receives
+the event. The broker backend is chosen with the NURSERY_EVENT_BROKER setting:
+
+- InMemoryBroker (default) fans events out within one process, which is enough for a
+  single ASGI worker.
+- RedisBroker relays events through Redis pub/sub so streams on every worker receive them.
+  It needs the optional redis package and NURSERY_EVENT_BROKER_URL.
+"""
+import asyncio
+import json
+import threading
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.module_loading import import_string
+
+# events buffered per stream before new ones are dropped (a slow client just refreshes)
+QUEUE_SIZE = 100
+
+
+class InMemoryBroker:
+    """Fans events out to the asyncio queues of the streams open in this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self, user_id):
+        """Returns a queue that receives the user's events. Must be called from the stream's event loop."""
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(user_id, {})[queue] = asyncio.get_running_loop()
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        with self._lock:
+            queues = self._subscribers.get(user_id, {})
+            queues.pop(queue, None)
+            if not queues:
+                self._subscribers.pop(user_id, None)
+
+    def publish(self, user_id, event):
+        """Sends an event dict to the user's streams. Safe to call from any thread."""
+        self.deliver(user_id, event)
+
+    def deliver(self, user_id, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, {}).items())
+        for queue, loop in subscribers:
+            # queues belong to their event loop, so hand the event over on that loop's thread
+            loop.call_soon_threadsafe(self._put, queue, event)
+
+    @staticmethod
+    def _put(queue, event):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            pass
+
+
+class RedisBroker(InMemoryBroker):
+    """Publishes events to Redis; one listener per process delivers them to local streams."""
+
+    CHANNEL_PREFIX = 'nursery:events:'
+
+    def __init__(self):
+        super().__init__()
+        try:
+            import redis
+            import redis.asyncio
+        except ImportError:
+            raise ImproperlyConfigured('RedisBroker requires the redis package')
+        url = getattr(settings, 'NURSERY_EVENT_BROKER_URL', None)
+        if not url:
+            raise ImproperlyConfigured('RedisBroker requires NURSERY_EVENT_BROKER_URL')
+        self._url = url
+        self._client = redis.Redis.from_url(url)
+        self._listeners = {}
+
+    def subscribe(self, user_id):
+        queue = super().subscribe(user_id)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if loop not in self._listeners:
+                self._listeners[loop] = loop.create_task(self._listen())
+        return queue
+
+    def publish(self, user_id, event):
+        self._client.publish(f'{self.CHANNEL_PREFIX}{user_id}', json.dumps(event, cls=DjangoJSONEncoder))
+
+    async def _listen(self):
+        import redis.asyncio
+        client = redis.asyncio.Redis.from_url(self._url)
+        async with client.pubsub() as pubsub:
+            await pubsub.psubscribe(f'{self.CHANNEL_PREFIX}*')
+            async for message in pubsub.listen():
+                if message['type'] != 'pmessage':
+                    continue
+                user_id = int(message['channel'].decode().removeprefix(self.CHANNEL_PREFIX))
+                self.deliver(user_id, json.loads(message['data']))
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                path = getattr(settings, 'NURSERY_EVENT_BROKER', 'nursery.events.InMemoryBroker')
+                _broker = import_string(path)()
+    return _broker
+
+
+def publish(user_id, event_type, **data):
+    """Sends an event of event_type to the user's open streams."""
+    if user_id is not None:
+        get_broker().publish(user_id, dict(data, type=event_type))
+
+
+def plant_instance_event(instance):
+    return {
+        'id': str(instance.pk),
+        'nickname': instance.nickname,
+        'location': instance.location_id,
+        'due_watered': instance.due_watered,
+        'overdue': instance.is_overdue_watered,
+    }
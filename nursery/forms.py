@@ -2,9 +2,13 @@ import datetime
 from django import forms
 from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
+from django.contrib.auth.models import User
+from nursery.models import Location, Plant, PlantInstance
 
 class RenewDueWateredDateForm(forms.Form):
     renewal_date = forms.DateField(help_text="Enter a date between now and 4 weeks (default 2).")
+    # version of the plant instance when the form was loaded, to detect concurrent renewals
+    version = forms.IntegerField(widget=forms.HiddenInput)
 
     def clean_renewal_date(self):
         data = self.cleaned_data['renewal_date']
@@ -18,4 +22,63 @@ class RenewDueWateredDateForm(forms.Form):
             raise ValidationError(_('Invalid date - renewal more than 4 weeks ahead'))
 
         # Remember to always return the cleaned data.
-        return data
\ No newline at end of file
+        return data
+
+class BulkMovePlantInstancesForm(forms.Form):
+    from_location = forms.ModelChoiceField(queryset=Location.objects.select_related('user'),
+                                           help_text="Move every plant in this location...")
+    to_location = forms.ModelChoiceField(queryset=Location.objects.select_related('user'),
+                                         help_text="...to this location.")
+    dry_run = forms.BooleanField(required=False, initial=True, help_text="Only report what would change.")
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('from_location') and cleaned_data.get('from_location') == cleaned_data.get('to_location'):
+            raise ValidationError(_('Invalid locations - choose two different locations'))
+        return cleaned_data
+
+
+class BulkReassignGardenForm(forms.Form):
+    from_user = forms.ModelChoiceField(queryset=User.objects.all(),
+                                       help_text="Transfer every location, plant and plant instance of this user...")
+    to_user = forms.ModelChoiceField(queryset=User.objects.all(), help_text="...to this user.")
+    dry_run = forms.BooleanField(required=False, initial=True, help_text="Only report what would change.")
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('from_user') and cleaned_data.get('from_user') == cleaned_data.get('to_user'):
+            raise ValidationError(_('Invalid users - choose two different users'))
+        return cleaned_data
+
+
+class BulkDeleteForm(forms.Form):
+    customer = forms.ModelChoiceField(queryset=User.objects.all(), required=False,
+                                      help_text="Delete every plant instance of this customer...")
+    location = forms.ModelChoiceField(queryset=Location.objects.select_related('user'), required=False,
+                                      help_text="...or every plant instance in this location.")
+    delete_locations = forms.BooleanField(required=False,
+                                          help_text="Also delete the customer's locations (or the location).")
+    delete_plants = forms.BooleanField(required=False, help_text="Also delete the customer's plants.")
+    dry_run = forms.BooleanField(required=False, initial=True, help_text="Only report what would change.")
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if bool(cleaned_data.get('customer')) == bool(cleaned_data.get('location')):
+            raise ValidationError(_('Invalid selection - choose either a customer or a location'))
+        if cleaned_data.get('location') and cleaned_data.get('delete_plants'):
+            raise ValidationError(_('Invalid selection - plants can only be deleted with a customer'))
+        return cleaned_data
+
+    def querysets(self):
+        """Returns the plant instances, locations and plants selected for deletion."""
+        customer, location = self.cleaned_data['customer'], self.cleaned_data['location']
+        if customer:
+            instances = PlantInstance.objects.filter(customer=customer)
+            locations = Location.objects.filter(user=customer)
+        else:
+            instances = PlantInstance.objects.filter(location=location)
+            locations = Location.objects.filter(pk=location.pk)
+        if not self.cleaned_data['delete_locations']:
+            locations = locations.none()
+        plants = Plant.objects.filter(user=customer) if self.cleaned_data['delete_plants'] else Plant.objects.none()
+        return instances, locations, plants
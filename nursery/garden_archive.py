@@ -0,0 +1,200 @@
+"""Export a user's garden as a zip of JSON-lines files, and restore such an archive.
+
+The archive holds manifest.json, locations.jsonl, plants.jsonl and plantinstances.jsonl.
+plants.jsonl also holds plants owned by someone else (e.g. staff templates) that the user's
+plant instances use, marked "external", so an archive can be restored on its own.
+Exports are streamed: rows are read from chunked queryset iterators and written through
+zipfile into a buffer that is emptied after every row batch, so neither the archive nor
+the querysets are ever held in memory whole.
+"""
+import datetime
+import io
+import json
+import uuid
+import zipfile
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import BooleanField, Case, Q, Value, When
+from .dashboard import invalidate_location_dashboard
+from .events import publish
+from .models import Location, Plant, PlantInstance
+
+ARCHIVE_VERSION = 1
+CHUNK_SIZE = 500
+
+LOCATION_FIELDS = ['id', 'name']
+PLANT_FIELDS = ['id', 'scientific_name', 'common_name', 'water', 'sun', 'description', 'care_tips']
+PLANT_INSTANCE_FIELDS = ['id', 'plant_id', 'location_id', 'nickname', 'purchased', 'due_watered']
+
+
+class _StreamBuffer(io.RawIOBase):
+    """Write-only, unseekable file object that hands back whatever was written since the last read."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def garden_querysets(user):
+    return [
+        ('locations.jsonl', Location.objects.filter(user=user).order_by('id').values(*LOCATION_FIELDS)),
+        ('plants.jsonl',
+         Plant.objects.filter(Q(user=user) | Q(plantinstance__customer=user)).distinct().order_by('id')
+         .values(*PLANT_FIELDS, external=Case(When(user=user, then=Value(False)), default=Value(True),
+                                              output_field=BooleanField()))),
+        ('plantinstances.jsonl',
+         PlantInstance.objects.filter(customer=user).order_by('id').values(*PLANT_INSTANCE_FIELDS)),
+    ]
+
+
+def stream_garden_archive(user):
+    """Yields the bytes of a zip archive of the user's locations, plants and plant instances."""
+    buffer = _StreamBuffer()
+    # zipfile writes data descriptors instead of seeking back when the output isn't seekable
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        manifest = {'version': ARCHIVE_VERSION, 'username': user.get_username(),
+                    'exported': datetime.datetime.now(datetime.timezone.utc)}
+        archive.writestr('manifest.json', json.dumps(manifest, cls=DjangoJSONEncoder))
+        yield buffer.pop()
+
+        for filename, queryset in garden_querysets(user):
+            with archive.open(filename, 'w', force_zip64=True) as f:
+                for i, row in enumerate(queryset.iterator(chunk_size=CHUNK_SIZE), 1):
+                    f.write(json.dumps(row, cls=DjangoJSONEncoder).encode() + b'\n')
+                    if i % CHUNK_SIZE == 0:
+                        yield buffer.pop()
+            yield buffer.pop()
+    yield buffer.pop()
+
+
+async def astream_garden_archive(user):
+    """Async iterator over stream_garden_archive(user), for responses served over ASGI.
+
+    Each chunk is built in the thread sync_to_async uses for this request, so the event loop
+    isn't blocked and Django doesn't have to read the whole archive into a list first.
+    """
+    chunks = stream_garden_archive(user)
+    try:
+        while (chunk := await sync_to_async(next)(chunks, None)) is not None:
+            yield chunk
+    finally:
+        await sync_to_async(chunks.close)()
+
+
+def _read_jsonl(archive, filename):
+    with archive.open(filename) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _unique_name(name, taken, max_length):
+    """Returns name, or name with a ' (n)' suffix if the owner already uses it, and marks it taken."""
+    candidate, n = name, 1
+    while candidate in taken:
+        n += 1
+        suffix = f' ({n})'
+        candidate = name[:max_length - len(suffix)] + suffix
+    taken.add(candidate)
+    return candidate
+
+
+def _bulk_create_mapped(model, rows, build, batch_size=CHUNK_SIZE):
+    """bulk_creates build(row) for each row in batches and returns {archived id: new id}."""
+    id_map = {}
+    batch = []
+
+    def flush():
+        created = model.objects.bulk_create([obj for _, obj in batch])
+        for (old_id, _), obj in zip(batch, created):
+            id_map[old_id] = obj.pk
+        batch.clear()
+
+    for row in rows:
+        batch.append((row['id'], build(row)))
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return id_map
+
+
+@transaction.atomic
+def restore_garden_archive(fileobj, user):
+    """Loads an archive made by stream_garden_archive() into user's garden.
+
+    Rows get new primary keys (and new UUIDs for plant instances); foreign keys are remapped
+    to the restored rows, and names the user already uses get a numbered suffix so the
+    per-owner unique constraints hold. External plants are linked to if they still exist
+    here, and otherwise restored as the user's own. Raises ValueError if a plant instance
+    refers to a plant that is neither in the archive nor in this database.
+    Returns the number of rows restored per model.
+    """
+    with zipfile.ZipFile(fileobj) as archive:
+        manifest = json.loads(archive.read('manifest.json'))
+        if manifest.get('version') != ARCHIVE_VERSION:
+            raise ValueError(f"Unsupported garden archive version: {manifest.get('version')}")
+
+        names = set(Location.objects.filter(user=user).values_list('name', flat=True))
+        name_length = Location._meta.get_field('name').max_length
+        location_ids = _bulk_create_mapped(Location, _read_jsonl(archive, 'locations.jsonl'), lambda row: Location(
+            user=user, name=_unique_name(row['name'], names, name_length)))
+
+        # external plants that still exist here (same id and name) are linked to, not copied
+        external = {row['id']: row['scientific_name'] for row in _read_jsonl(archive, 'plants.jsonl')
+                    if row.get('external')}
+        linked = {pk: pk for pk, name in Plant.objects.filter(id__in=external).values_list('id', 'scientific_name')
+                  if external[pk] == name}
+
+        names = set(Plant.objects.filter(user=user).values_list('scientific_name', flat=True))
+        name_length = Plant._meta.get_field('scientific_name').max_length
+        plant_ids = _bulk_create_mapped(
+            Plant, (row for row in _read_jsonl(archive, 'plants.jsonl') if row['id'] not in linked),
+            lambda row: Plant(user=user, **dict(
+                {field: row[field] for field in PLANT_FIELDS if field != 'id'},
+                scientific_name=_unique_name(row['scientific_name'], names, name_length))))
+
+        restored_locations, restored_plants = len(location_ids), len(plant_ids)
+        plant_ids.update(linked)
+
+        # archives from before external plants were exported may still refer to plants or locations
+        # owned by someone else; keep those links if the rows exist here
+        external_plants, external_locations = set(), set()
+        for row in _read_jsonl(archive, 'plantinstances.jsonl'):
+            if row['plant_id'] is not None and row['plant_id'] not in plant_ids:
+                external_plants.add(row['plant_id'])
+            if row['location_id'] is not None and row['location_id'] not in location_ids:
+                external_locations.add(row['location_id'])
+        plant_ids.update((pk, pk) for pk in Plant.objects.filter(id__in=external_plants).values_list('id', flat=True))
+        missing = external_plants - plant_ids.keys()
+        if missing:
+            raise ValueError(f"Plant instances refer to plants that are neither in the archive nor in this "
+                             f"database (ids {', '.join(str(pk) for pk in sorted(missing))})")
+        # a missing location is only dropped: plant instances don't need one
+        location_ids.update(
+            (pk, pk) for pk in Location.objects.filter(id__in=external_locations).values_list('id', flat=True))
+
+        names = set(PlantInstance.objects.filter(customer=user).values_list('nickname', flat=True))
+        name_length = PlantInstance._meta.get_field('nickname').max_length
+        instance_ids = _bulk_create_mapped(
+            PlantInstance, _read_jsonl(archive, 'plantinstances.jsonl'), lambda row: PlantInstance(
+                id=uuid.uuid4(), customer=user,
+                plant_id=plant_ids.get(row['plant_id']),
+                location_id=location_ids.get(row['location_id']),
+                nickname=_unique_name(row['nickname'], names, name_length),
+                purchased=row['purchased'], due_watered=row['due_watered']))
+
+    transaction.on_commit(lambda: (invalidate_location_dashboard(user.pk), publish(user.pk, 'refresh')))
+    return {'locations': restored_locations, 'plants': restored_plants, 'plant instances': len(instance_ids)}
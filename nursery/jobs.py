@@ -0,0 +1,65 @@
+"""Background jobs run by the task queue. Enqueue them with nursery.tasks.enqueue('nursery.jobs.<name>', ...)."""
+import datetime
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.mail import send_mass_mail
+from django.db.models import F
+from django.conf import settings
+from .dashboard import invalidate_location_dashboard
+from .events import publish
+from .metrics import RENEWALS
+from .models import PlantInstance
+from .photos import VARIANTS, build_variants, delete_unreferenced_files
+
+
+def renew_due_watered(user_id, renewal_date, plant_instance_ids=None):
+    """Sets a new due watered date on a user's overdue plant instances (or the given ones)."""
+    renewal_date = datetime.date.fromisoformat(renewal_date)
+    queryset = PlantInstance.objects.filter(customer_id=user_id)
+    if plant_instance_ids is None:
+        queryset = queryset.filter(due_watered__lte=datetime.date.today())
+    else:
+        queryset = queryset.filter(id__in=plant_instance_ids)
+    updated = queryset.update(due_watered=renewal_date, version=F('version') + 1)
+    RENEWALS.inc(updated)
+    # update() doesn't send post_save
+    invalidate_location_dashboard(user_id)
+    publish(user_id, 'refresh')
+    return updated
+
+
+def send_watering_digests():
+    """Emails every user with an email address a list of their plants due to be watered."""
+    today = datetime.date.today()
+    due = (
+        PlantInstance.objects.filter(due_watered__lte=today, customer__isnull=False)
+        .exclude(customer__email='')
+        .order_by('customer_id', 'due_watered')
+        .values_list('customer_id', 'nickname', 'location__name', 'due_watered')
+    )
+    plants_by_user = {}
+    for customer_id, nickname, location, due_watered in due.iterator(chunk_size=2000):
+        plants_by_user.setdefault(customer_id, []).append(f'- {nickname} ({location}), due {due_watered}')
+
+    emails = User.objects.filter(id__in=plants_by_user).values_list('id', 'email')
+    messages = [
+        ('Plants due to be watered', '\n'.join(plants_by_user[user_id]),
+         settings.DEFAULT_FROM_EMAIL, [email])
+        for user_id, email in emails
+    ]
+    return send_mass_mail(messages, fail_silently=False)
+
+
+def generate_photo_variants(model_name, pk):
+    """Creates the thumbnail, detail and WebP variants of a Plant or PlantInstance photo."""
+    model = apps.get_model('nursery', model_name)
+    obj = model.objects.filter(pk=pk).first()
+    if obj is None or not obj.image_variants_pending:
+        return 0
+    previous = [getattr(obj, field_name).name for field_name in VARIANTS]
+    names = build_variants(obj)
+    # only store the variants if the photo wasn't replaced while they were being generated
+    updated = model.objects.filter(pk=pk, image=obj.image.name).update(image_variants_of=obj.image.name, **names)
+    # drop whichever variants (the replaced ones, or the unused new ones) nothing refers to
+    delete_unreferenced_files(previous if updated else names.values())
+    return updated
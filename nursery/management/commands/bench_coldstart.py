@@ -0,0 +1,81 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Run in a fresh interpreter so every sample starts from a cold worker.
+WORKER_SCRIPT = r"""
+import io, json, os, sys, time
+start = time.perf_counter()
+from petrichor.wsgi import application
+booted = time.perf_counter()
+
+def request(path):
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '',
+        'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1',
+        'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr, 'wsgi.multithread': False, 'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    status = []
+    t = time.perf_counter()
+    body = b''.join(application(environ, lambda s, h, exc_info=None: status.append(s)))
+    return time.perf_counter() - t, status[0]
+
+paths = sys.argv[1:]
+first = [request(p) for p in paths]
+second = [request(p) for p in paths]
+print(json.dumps({
+    'boot': booted - start,
+    'first_response': booted - start + first[0][0],
+    'first': [f[0] for f in first],
+    'second': [s[0] for s in second],
+    'status': [f[1] for f in first],
+}))
+"""
+
+
+class Command(BaseCommand):
+    help = "Measures cold-start time to first response and first-request latency with and without warm-up."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5, help='fresh worker processes per mode')
+        parser.add_argument('paths', nargs='*', default=['/nursery/', '/accounts/login/'])
+
+    def run_worker(self, paths, warmup):
+        env = dict(os.environ)
+        env['DJANGO_SETTINGS_MODULE'] = os.environ.get('DJANGO_SETTINGS_MODULE', 'petrichor.settings')
+        env['PETRICHOR_WARMUP'] = '1' if warmup else '0'
+        result = subprocess.run(
+            [sys.executable, '-c', WORKER_SCRIPT, *paths],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, check=True,
+        )
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+    def handle(self, *args, **options):
+        paths = options['paths']
+        for warmup in (False, True):
+            samples = [self.run_worker(paths, warmup) for _ in range(options['runs'])]
+            # timing error pages would say nothing about the real pages (e.g. an unmigrated DB)
+            failed = {path: status for sample in samples for path, status in zip(paths, sample['status'])
+                      if not status.startswith('2')}
+            if failed:
+                raise CommandError('Non-2xx responses: ' + ', '.join(f'{path} ({status})'
+                                                                     for path, status in failed.items()))
+            label = 'with warm-up' if warmup else 'without warm-up'
+            self.stdout.write(self.style.MIGRATE_HEADING(f"{label} ({options['runs']} runs, median ms)"))
+            self.stdout.write(f"  boot:                    {self.median(samples, 'boot'):8.2f}")
+            self.stdout.write(f"  cold start to response:  {self.median(samples, 'first_response'):8.2f}")
+            for i, path in enumerate(paths):
+                first = statistics.median(s['first'][i] for s in samples) * 1000
+                second = statistics.median(s['second'][i] for s in samples) * 1000
+                self.stdout.write(
+                    f"  {path:<24} first {first:8.2f}  steady {second:8.2f}  ({samples[0]['status'][i]})"
+                )
+
+    def median(self, samples, key):
+        return statistics.median(s[key] for s in samples) * 1000
@@ -0,0 +1,100 @@
+import datetime
+import threading
+import time
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+from nursery.models import ConcurrentUpdateError, Location, Plant, PlantInstance
+
+
+class Command(BaseCommand):
+    help = ("Runs parallel writers that renew the same plant instance, once with full-row save() and once "
+            "with versioned field-limited updates, and reports lost updates and time spent in UPDATEs. "
+            "Runs on a throwaway test database, never on the configured one.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=8)
+        parser.add_argument('--renewals', type=int, default=25, help='renewals per writer')
+        parser.add_argument('--noinput', '--no-input', action='store_false', dest='interactive',
+                            help='destroy a leftover test database without asking')
+
+    def handle(self, *args, **options):
+        # the same throwaway database "manage.py test" uses (in memory for SQLite)
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=not options['interactive'], serialize=False)
+        try:
+            self.benchmark(options['writers'], options['renewals'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def benchmark(self, writers, renewals):
+        user = User.objects.create_user('bench-concurrency')
+        location = Location.objects.create(user=user, name='Bench')
+        plant = Plant.objects.create(user=user, scientific_name='Benchmarkia concurrens', water='r', sun='p')
+        expected = writers * renewals
+        for mode in ('save', 'versioned'):
+            instance = PlantInstance.objects.create(plant=plant, customer=user, location=location,
+                                                    nickname=mode, due_watered=datetime.date(2000, 1, 1))
+            totals = self.run_writers(instance.pk, mode, writers, renewals)
+            instance.refresh_from_db()
+            # every renewal pushes the due date back one day, so lost updates show up as missing days
+            applied = (instance.due_watered - datetime.date(2000, 1, 1)).days
+            self.stdout.write(
+                f"{mode:>9}: {applied}/{expected} renewals kept, {expected - applied} lost, "
+                f"{totals['retries']} retries, {totals['updates']} UPDATEs averaging "
+                f"{totals['update_seconds'] / max(totals['updates'], 1) * 1000:.3f} ms"
+            )
+            if mode == 'versioned' and applied != expected:
+                raise CommandError(f'versioned updates lost {expected - applied} renewals')
+
+    def run_writers(self, pk, mode, writers, renewals):
+        lock = threading.Lock()
+        totals = {'update_seconds': 0.0, 'updates': 0, 'retries': 0}
+        start = threading.Barrier(writers)
+
+        def time_updates(execute, sql, params, many, context):
+            # time spent in UPDATEs is time the row (or, on SQLite, the database) is write-locked
+            began = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                if sql.lstrip().upper().startswith('UPDATE'):
+                    with lock:
+                        totals['update_seconds'] += time.perf_counter() - began
+                        totals['updates'] += 1
+
+        def writer():
+            try:
+                with connection.execute_wrapper(time_updates):
+                    start.wait()
+                    for _ in range(renewals):
+                        while not self.renew(pk, mode):
+                            with lock:
+                                totals['retries'] += 1
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=writer) for _ in range(writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return totals
+
+    def renew(self, pk, mode):
+        """Reads the instance and pushes its due date back a day. Returns False if it must be retried."""
+        try:
+            instance = PlantInstance.objects.get(pk=pk)
+            instance.due_watered += datetime.timedelta(days=1)
+            # give other writers a chance to read the same row, as two devices would
+            time.sleep(0.001)
+            if mode == 'save':
+                instance.save()
+            else:
+                instance.save_versioned(['due_watered'])
+            return True
+        except ConcurrentUpdateError:
+            return False
+        except OperationalError:
+            # SQLite "database is locked"
+            return False
@@ -0,0 +1,36 @@
+import zipfile
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from nursery.garden_archive import restore_garden_archive
+
+
+class Command(BaseCommand):
+    help = "Restores a garden export archive into a new or existing user's garden."
+
+    def add_arguments(self, parser):
+        parser.add_argument('archive', help='zip file downloaded from the garden export')
+        parser.add_argument('username', help='user to restore the garden into')
+        parser.add_argument('--create-user', action='store_true', help="create the user if it doesn't exist")
+
+    def handle(self, *args, **options):
+        username = options['username']
+        if options['create_user']:
+            user, created = User.objects.get_or_create(username=username)
+            if created:
+                user.set_unusable_password()
+                user.save()
+        else:
+            try:
+                user = User.objects.get(username=username)
+            except User.DoesNotExist:
+                raise CommandError(f'User "{username}" does not exist (use --create-user)')
+
+        try:
+            with open(options['archive'], 'rb') as f:
+                counts = restore_garden_archive(f, user)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            raise CommandError(f'Could not restore {options["archive"]}: {e}')
+        self.stdout.write(self.style.SUCCESS(
+            f"Restored {counts['locations']} locations, {counts['plants']} plants and "
+            f"{counts['plant instances']} plant instances into {user}"
+        ))
@@ -0,0 +1,85 @@
+import os
+import socket
+import time
+from concurrent.futures import FIRST_COMPLETED, BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from django.core.management.base import BaseCommand
+from django.db import connections
+from nursery import metrics, tasks
+
+
+def init_process():
+    """Sets up Django in each pool process so task functions can use the ORM and record metrics."""
+    import django
+    django.setup()
+    metrics.REGISTRY.start_flusher()
+
+
+class Command(BaseCommand):
+    help = "Runs queued nursery tasks on a thread or process pool."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='number of tasks run at once')
+        parser.add_argument('--pool', choices=['thread', 'process'], default='thread')
+        parser.add_argument('--visibility-timeout', type=int, default=tasks.DEFAULT_VISIBILITY_TIMEOUT,
+                            help='seconds before a claimed task is considered abandoned')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='seconds between polls when idle')
+        parser.add_argument('--once', action='store_true', help='exit once the queue is empty')
+
+    def make_executor(self, options):
+        # don't share the parent's database connection with forked pool processes
+        connections.close_all()
+        if options['pool'] == 'process':
+            return ProcessPoolExecutor(max_workers=options['workers'], initializer=init_process)
+        return ThreadPoolExecutor(max_workers=options['workers'])
+
+    def handle(self, *args, **options):
+        worker_id = f'{socket.gethostname()}:{os.getpid()}'
+        timeout = options['visibility_timeout']
+        # jobs run in this process's threads (or in pool processes) also report to /metrics
+        metrics.REGISTRY.start_flusher()
+        executor = self.make_executor(options)
+
+        running = {}
+        try:
+            while True:
+                free = options['workers'] - len(running)
+                if free:
+                    for task in tasks.claim(worker_id, limit=free, visibility_timeout=timeout):
+                        try:
+                            future = executor.submit(tasks.execute, task.name, task.args, task.kwargs)
+                        except BrokenExecutor as e:
+                            # a pool process died; record the attempt (fail() schedules the retry) and replace the pool
+                            # (tasks still running on the old pool fail with the same error below)
+                            tasks.fail(task, worker_id, repr(e))
+                            self.stderr.write(f'failed {task.name} {task.id} (pool broken, restarting it)')
+                            executor.shutdown(wait=False, cancel_futures=True)
+                            executor = self.make_executor(options)
+                            continue
+                        running[future] = task
+
+                if not running:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+
+                done, _ = wait(running, timeout=options['poll_interval'], return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    try:
+                        error = future.result()
+                    except Exception as e:
+                        # the pool itself failed (e.g. a process crashed)
+                        error = repr(e)
+                    if error is None:
+                        tasks.complete(task, worker_id)
+                        self.stdout.write(f'done   {task.name} {task.id}')
+                    else:
+                        tasks.fail(task, worker_id, error)
+                        self.stderr.write(f'failed {task.name} {task.id} (attempt {task.attempts}/{task.max_attempts})')
+                if running:
+                    tasks.extend([task.id for task in running.values()], worker_id, timeout)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
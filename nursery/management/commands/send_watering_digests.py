@@ -0,0 +1,13 @@
+import datetime
+from django.core.management.base import BaseCommand
+from nursery.tasks import enqueue
+
+
+class Command(BaseCommand):
+    help = "Queues today's watering digest emails. Run it daily (e.g. from cron) alongside run_tasks."
+
+    def handle(self, *args, **options):
+        today = datetime.date.today()
+        # calling it again while today's digests are still queued doesn't queue them twice
+        task = enqueue('nursery.jobs.send_watering_digests', dedup_key=f'watering-digests:{today}')
+        self.stdout.write(self.style.SUCCESS(f'Queued watering digests for {today} (task {task.id})'))
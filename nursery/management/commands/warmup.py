@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from nursery.warmup import warm_up
+
+
+class Command(BaseCommand):
+    help = "Preloads templates, URL resolvers and model metadata, and checks the database connections."
+
+    def handle(self, *args, **options):
+        stats = warm_up()
+        self.stdout.write(self.style.SUCCESS(
+            f"Warmed {stats['templates']} templates, {stats['urls']} URL names, "
+            f"{stats['models']} models and checked {stats['connections']} connections "
+            f"in {stats['seconds'] * 1000:.1f} ms"
+        ))
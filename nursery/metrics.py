@@ -0,0 +1,252 @@
+"""In-process metrics exposed in the Prometheus text format by the metrics view.
+
+Each metric keeps its samples in a dict guarded by its own lock, held only for the dict update.
+With several worker processes, set METRICS_DIR to a directory shared by the workers: every
+process then writes a snapshot of its samples there every METRICS_FLUSH_INTERVAL seconds,
+and the scrape endpoint adds up the counters and histograms of all processes. Gauges are
+not merged: they describe the whole site and every process sets them from the same shared
+value at scrape time (see refresh_business_gauges). Snapshots of processes that exited are
+removed after METRICS_STALE_AFTER seconds, so their counts drop out of the totals, which
+Prometheus treats as a counter reset.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from django.conf import settings
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._samples = {}
+        REGISTRY.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def snapshot(self):
+        with self._lock:
+            samples = [[list(key), value] for key, value in self._samples.items()]
+        return {'type': self.type, 'help': self.help, 'labelnames': list(self.labelnames), 'samples': samples}
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._samples[key] = self._samples.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._samples[key] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labelnames)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        # find the bucket outside the lock; counts are made cumulative when exposed
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            sample = self._samples.get(key)
+            if sample is None:
+                sample = self._samples[key] = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0}
+            sample['buckets'][index] += 1
+            sample['sum'] += value
+
+    def snapshot(self):
+        with self._lock:
+            samples = [[list(key), {'buckets': list(value['buckets']), 'sum': value['sum']}]
+                       for key, value in self._samples.items()]
+        return {'type': self.type, 'help': self.help, 'labelnames': list(self.labelnames),
+                'buckets': list(self.buckets), 'samples': samples}
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        # process the flusher thread runs in (threads don't survive fork)
+        self._flusher_pid = None
+        self._flusher_lock = threading.Lock()
+        # the flusher thread and scrapes both flush, and would share the temporary file
+        self._flush_lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        """Starts the forked process (e.g. a gunicorn --preload or pool worker) from empty samples.
+
+        The samples inherited from the parent are still counted in the parent's snapshot, and
+        the parent's flusher thread doesn't exist here, so start one if the parent had one.
+        """
+        for metric in self.metrics:
+            metric._lock = threading.Lock()
+            metric._samples = {}
+        self._flusher_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        if self._flusher_pid is not None:
+            self._flusher_pid = None
+            self.start_flusher()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+    def snapshot_path(self):
+        return os.path.join(settings.METRICS_DIR, f'{os.getpid()}.json')
+
+    def flush(self):
+        """Writes this process's snapshot to METRICS_DIR, atomically replacing the previous one."""
+        if not getattr(settings, 'METRICS_DIR', None):
+            return
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        path = self.snapshot_path()
+        with self._flush_lock:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(path + '.tmp', path)
+
+    def start_flusher(self):
+        """Starts a daemon thread that flushes this process's snapshot periodically.
+
+        Called by every kind of process that records metrics (MetricsMiddleware, run_tasks and
+        its pool processes); does nothing if this process already has a flusher.
+        """
+        if not getattr(settings, 'METRICS_DIR', None):
+            return
+        with self._flusher_lock:
+            if self._flusher_pid == os.getpid():
+                return
+            if self._flusher_pid is None:
+                atexit.register(self.flush)
+            self._flusher_pid = os.getpid()
+            interval = getattr(settings, 'METRICS_FLUSH_INTERVAL', 10)
+
+            def run():
+                while True:
+                    time.sleep(interval)
+                    self.flush()
+            threading.Thread(target=run, name='metrics-flusher', daemon=True).start()
+
+    def collect(self):
+        """Returns this process's snapshot with the counters and histograms of the other processes added."""
+        merged = self.snapshot()
+        if not getattr(settings, 'METRICS_DIR', None):
+            return merged
+        self.flush()
+        own = os.path.basename(self.snapshot_path())
+        stale_before = time.time() - getattr(settings, 'METRICS_STALE_AFTER', 60)
+        for filename in os.listdir(settings.METRICS_DIR):
+            if not filename.endswith('.json') or filename == own:
+                continue
+            path = os.path.join(settings.METRICS_DIR, filename)
+            try:
+                if os.path.getmtime(path) < stale_before:
+                    # the process exited (or stopped flushing) without cleaning up
+                    os.remove(path)
+                    continue
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, metric in snapshot.items():
+                if name in merged and metric['type'] != 'gauge':
+                    merge(merged[name], metric)
+        return merged
+
+
+def merge(into, metric):
+    """Adds the samples of one process's counter or histogram snapshot into another."""
+    samples = {tuple(key): value for key, value in into['samples']}
+    for key, value in metric['samples']:
+        key = tuple(key)
+        if key not in samples:
+            samples[key] = value
+        elif metric['type'] == 'histogram':
+            samples[key] = {'buckets': [a + b for a, b in zip(samples[key]['buckets'], value['buckets'])],
+                            'sum': samples[key]['sum'] + value['sum']}
+        else:
+            samples[key] += value
+    into['samples'] = [[list(key), value] for key, value in samples.items()]
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(str(value))}"' for name, value in pairs) + '}'
+
+
+def render(snapshot):
+    """Formats a (merged) snapshot in the Prometheus text exposition format."""
+    lines = []
+    for name, metric in snapshot.items():
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for key, value in metric['samples']:
+            if metric['type'] == 'histogram':
+                cumulative = 0
+                bounds = [str(bound) for bound in metric['buckets']] + ['+Inf']
+                for bound, count in zip(bounds, value['buckets']):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(metric['labelnames'], key, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{_labels(metric['labelnames'], key)} {value['sum']}")
+                lines.append(f"{name}_count{_labels(metric['labelnames'], key)} {cumulative}")
+            else:
+                lines.append(f"{name}{_labels(metric['labelnames'], key)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_LATENCY = Histogram('nursery_request_duration_seconds', 'Request latency by URL name.',
+                            ['view', 'method', 'status'])
+DB_QUERIES = Counter('nursery_db_queries_total', 'Database queries run by each view.', ['view'])
+DB_QUERY_TIME = Counter('nursery_db_query_seconds_total', 'Time spent in database queries by each view.', ['view'])
+CACHE_REQUESTS = Counter('nursery_cache_requests_total', 'Cache lookups by cache and result (hit or miss).',
+                         ['cache', 'result'])
+RENEWALS = Counter('nursery_renewals_total', 'Due watered dates renewed (rate() gives renewals per minute).')
+OVERDUE_PLANT_INSTANCES = Gauge('nursery_overdue_plant_instances', 'Plant instances due to be watered.')
+
+
+def refresh_business_gauges():
+    """Updates the business gauges, recomputing them at most every METRICS_GAUGE_INTERVAL seconds.
+
+    The computed values are shared through the cache, so one scrape per interval (from any
+    worker) runs the queries and every other scrape reuses the result.
+    """
+    import datetime
+    from django.core.cache import cache
+    from .models import PlantInstance
+
+    overdue = cache.get('metrics:overdue-plant-instances')
+    if overdue is None:
+        overdue = PlantInstance.objects.filter(due_watered__lte=datetime.date.today()).count()
+        cache.set('metrics:overdue-plant-instances', overdue, getattr(settings, 'METRICS_GAUGE_INTERVAL', 60))
+    OVERDUE_PLANT_INSTANCES.set(overdue)
@@ -0,0 +1,80 @@
+import contextvars
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from .metrics import DB_QUERIES, DB_QUERY_TIME, REGISTRY, REQUEST_LATENCY
+
+# Query count and time of the request being handled. Context variables follow the request
+# into the thread that runs a sync view under ASGI, so the wrapper below sees them there too.
+_request_queries = contextvars.ContextVar('request_queries', default=None)
+
+
+def count_query(execute, sql, params, many, context):
+    queries = _request_queries.get()
+    if queries is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        queries['count'] += 1
+        queries['seconds'] += time.perf_counter() - start
+
+
+@receiver(connection_created)
+def install_query_counter(sender, connection, **kwargs):
+    """Times every query on every connection, in whichever thread opened it."""
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+def view_name(request):
+    """Labels metrics by URL name (e.g. 'my-plants') so URLs with ids don't create new series."""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    return match.view_name or match._func_path
+
+
+class MetricsMiddleware:
+    """Records request latency per URL name, and the database queries and query time of each view."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+        REGISTRY.start_flusher()
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        queries = {'count': 0, 'seconds': 0.0}
+        token = _request_queries.set(queries)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_queries.reset(token)
+        self.record(request, response, time.perf_counter() - start, queries)
+        return response
+
+    async def __acall__(self, request):
+        queries = {'count': 0, 'seconds': 0.0}
+        token = _request_queries.set(queries)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_queries.reset(token)
+        self.record(request, response, time.perf_counter() - start, queries)
+        return response
+
+    def record(self, request, response, seconds, queries):
+        view = view_name(request)
+        REQUEST_LATENCY.observe(seconds, view=view, method=request.method, status=response.status_code)
+        DB_QUERIES.inc(queries['count'], view=view)
+        DB_QUERY_TIME.inc(queries['seconds'], view=view)
@@ -1,18 +1,122 @@
-from django.db import models
+from django.db import models, router
+from django.db.models import F
+from django.db.models.signals import post_save
 from django.urls import reverse # Used in get_absolute_url() to get URL for specified ID
 from django.db.models import UniqueConstraint # Constrains fields to unique values
 from django.db.models.functions import Lower # Returns lower cased value of field
+import os
 import uuid # Required for unique plant instances
 from django.conf import settings
 from django.contrib.auth.models import User
 from datetime import date
+from django.utils import timezone
 
-class Location(models.Model):
+class ConcurrentUpdateError(Exception):
+    """Raised when a row was changed by someone else since it was read."""
+
+class VersionedModel(models.Model):
+    """Abstract model adding a version number for optimistic concurrency control.
+
+    save_versioned() writes only the given fields, and only if the row still has the version
+    that was read, so concurrent edits are detected instead of silently overwriting each other.
+    save() (used by the admin, for example) doesn't check the version, but still bumps it.
+    """
+    version = models.PositiveIntegerField(default=1, editable=False)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        """Saves the row; updating an existing row also increments its version in the database.
+
+        The version isn't checked, so this can still overwrite a concurrent change, but edit
+        forms loaded before it will report a conflict instead of overwriting it in turn.
+        """
+        if kwargs.get('update_fields') is not None and not self._state.adding:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'version'}
+        super().save(*args, **kwargs)
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        # Write version = version + 1 in the UPDATE itself and bump the in-memory copy to match,
+        # so save() needs no extra query and post_save handlers see a plain number.
+        if self._state.adding:
+            return super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+        values = [(field, model, F('version') + 1 if field.attname == 'version' else value)
+                  for field, model, value in values]
+        updated = super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+        if updated and any(field.attname == 'version' for field, _, _ in values):
+            self.version += 1
+        return updated
+
+    def save_versioned(self, fields):
+        """Saves `fields` with a single conditional UPDATE and bumps the version.
+
+        Raises ConcurrentUpdateError (and changes nothing) if the row's version in the database
+        is no longer self.version.
+        """
+        using = router.db_for_write(type(self), instance=self)
+        concrete = [self._meta.get_field(name) for name in fields]
+        # pre_save() lets fields such as ImageField store a new upload before the UPDATE
+        values = {field.attname: field.pre_save(self, False) for field in concrete}
+        updated = (
+            type(self)._base_manager.using(using)
+            .filter(pk=self.pk, version=self.version)
+            .update(version=F('version') + 1, **values)
+        )
+        if not updated:
+            raise ConcurrentUpdateError(f'{self._meta.verbose_name} {self.pk} was changed by someone else')
+        self.version += 1
+        # update() doesn't send post_save, but the cache, event and photo handlers rely on it
+        post_save.send(sender=type(self), instance=self, created=False, update_fields=frozenset(fields),
+                       raw=False, using=using)
+
+def photo_upload_to(instance, filename):
+    """Stores uploaded photos under a random name rather than the uploader's file name."""
+    extension = os.path.splitext(filename)[1].lower()
+    return f'photos/{uuid.uuid4().hex}{extension}'
+
+class PhotoModel(models.Model):
+    """Abstract model adding an uploaded photo and the resized variants generated from it.
+
+    Variants are created by the nursery.jobs.generate_photo_variants background task after the
+    photo is saved, and have content-hashed file names so they can be cached indefinitely.
+    Files no row refers to any more are deleted by nursery.signals.
+    """
+    image = models.ImageField(upload_to=photo_upload_to, null=True, blank=True, help_text='upload a photo')
+    image_thumbnail = models.ImageField(upload_to='variants', null=True, blank=True, editable=False)
+    image_detail = models.ImageField(upload_to='variants', null=True, blank=True, editable=False)
+    image_webp = models.ImageField(upload_to='variants', null=True, blank=True, editable=False)
+    # name of the photo the variants above were generated from
+    image_variants_of = models.CharField(max_length=100, blank=True, editable=False)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # photo as loaded, so nursery.signals can delete it once it's replaced or cleared
+        instance._loaded_image = str(instance.__dict__.get('image') or '')
+        return instance
+
+    @property
+    def image_variants_pending(self):
+        """True while the uploaded photo has no generated variants yet."""
+        return bool(self.image) and self.image.name != self.image_variants_of
+
+class Location(VersionedModel):
     """Model representing a Location (e.g. Living Room, Kitchen, etc.)"""
     user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
     name = models.CharField(max_length=50,
                             help_text="Enter the plant's Location (e.g. Living Room, Kitchen, etc.)")
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # owner as loaded, so nursery.signals can also refresh the previous owner's caches
+        instance._loaded_user_id = instance.__dict__.get('user_id')
+        return instance
+
     def get_absolute_url(self):
         """Returns the url to access a particular location instance."""
         return reverse('location-detail', args=[str(self.id)])
@@ -26,7 +130,7 @@ class Location(models.Model):
         constraints = [models.UniqueConstraint(fields=['user', 'name'], 
                                                name='unique_name_per_owner')]
 
-class Plant(models.Model):
+class Plant(PhotoModel, VersionedModel):
     """Model representing a type of plant."""
     user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
     scientific_name = models.CharField(max_length=200)
@@ -59,8 +163,6 @@ class Plant(models.Model):
         help_text='sun light preference',
     )
 
-    #image = models.ImageField(upload_to='Plants')
-
     description = models.TextField(max_length=1000, help_text="Enter a brief description of the plant")
     
     care_tips = models.TextField(max_length=1000, help_text="Enter a few care tips for the plant")
@@ -79,7 +181,7 @@ class Plant(models.Model):
         """Returns the URL to access a detail record for this plant."""
         return reverse('plant-detail', args=[str(self.id)])
 
-class PlantInstance(models.Model):
+class PlantInstance(PhotoModel, VersionedModel):
     """Model representing an instance of a type of plant."""
     plant = models.ForeignKey(Plant, on_delete=models.RESTRICT, null=True)
     customer = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
@@ -95,6 +197,13 @@ class PlantInstance(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4,
                           help_text="Unique ID for this particular plant across whole nursery")
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # owner as loaded, so nursery.signals can also refresh the previous owner's caches
+        instance._loaded_customer_id = instance.__dict__.get('customer_id')
+        return instance
+
     @property
     def is_overdue_watered(self):
         """Determines if the plant is overdue to be watered on due date and current date."""
@@ -121,3 +230,49 @@ class PlantInstance(models.Model):
 
     display_common_name.short_description = 'Common Name'
 
+
+
+class Task(models.Model):
+    """Model representing a background job stored in the database and run by the run_tasks command."""
+    STATUS = (
+        ('q', 'queued'),
+        ('r', 'running'),
+        ('d', 'done'),
+        ('f', 'failed'),
+    )
+
+    # dotted path to the function to run (e.g. 'nursery.jobs.send_watering_digests')
+    name = models.CharField(max_length=200)
+    args = models.JSONField(default=list, blank=True)
+    kwargs = models.JSONField(default=dict, blank=True)
+    # higher priority tasks are claimed first
+    priority = models.SmallIntegerField(default=0)
+    # only one queued or running task may share a dedup key
+    dedup_key = models.CharField(max_length=200, null=True, blank=True)
+
+    status = models.CharField(max_length=1, choices=STATUS, default='q')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=3)
+    # earliest time the task may run; pushed back on retry
+    available_at = models.DateTimeField(default=timezone.now)
+    # a running task whose lock has expired is treated as abandoned and claimed again
+    locked_until = models.DateTimeField(null=True, blank=True)
+    locked_by = models.CharField(max_length=100, blank=True)
+    last_error = models.TextField(blank=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-priority', 'available_at']
+        indexes = [
+            models.Index(fields=['status', 'available_at'], name='task_status_available_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['dedup_key'], condition=models.Q(status__in=['q', 'r']),
+                                    name='unique_pending_task_dedup_key')
+        ]
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'{self.name} ({self.get_status_display()}) {self.id}'
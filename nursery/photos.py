@@ -0,0 +1,74 @@
+import hashlib
+import io
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+# (suffix, max size, format) of each variant generated for an uploaded photo
+VARIANTS = {
+    'image_thumbnail': ('thumb', (160, 160), 'JPEG'),
+    'image_detail': ('detail', (800, 800), 'JPEG'),
+    'image_webp': ('detail', (800, 800), 'WEBP'),
+}
+EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp'}
+PHOTO_FIELDS = ['image', *VARIANTS]
+
+
+def content_hash(field_file):
+    """Hashes a stored file in chunks, without reading it into memory at once."""
+    digest = hashlib.sha256()
+    with field_file.open('rb') as f:
+        for chunk in f.chunks():
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def render_variant(image, size, image_format):
+    """Returns the bytes of `image` shrunk to fit `size` and encoded as `image_format`."""
+    variant = image.copy()
+    variant.thumbnail(size, Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    variant.save(buffer, image_format, quality=82, optimize=True)
+    return buffer.getvalue()
+
+
+def build_variants(obj):
+    """Generates and stores the resized variants of obj.image; returns {field name: stored name}.
+
+    Variant names are derived from the photo's content hash, so an existing variant is reused
+    rather than regenerated, and a stored name never refers to different content.
+    """
+    digest = content_hash(obj.image)
+    names = {}
+    image = None
+    for field_name, (suffix, size, image_format) in VARIANTS.items():
+        field = obj._meta.get_field(field_name)
+        name = f'{field.upload_to}/{digest}-{suffix}.{EXTENSIONS[image_format]}'
+        if not field.storage.exists(name):
+            if image is None:
+                with obj.image.open('rb') as f:
+                    image = Image.open(f)
+                    # apply camera orientation and drop alpha/palette so every format can encode it
+                    image = ImageOps.exif_transpose(image).convert('RGB')
+            name = field.storage.save(name, ContentFile(render_variant(image, size, image_format)))
+        names[field_name] = name
+    return names
+
+
+def delete_unreferenced_files(names):
+    """Deletes those of the given stored photo files that no Plant or PlantInstance refers to.
+
+    Variants are shared by every row whose photo has the same content, so a file is only
+    deleted once nothing refers to it any more.
+    """
+    from .models import Plant, PlantInstance
+
+    names = {name for name in names if name}
+    for model in (Plant, PlantInstance):
+        for field_name in PHOTO_FIELDS:
+            if names:
+                names -= set(model.objects.filter(**{f'{field_name}__in': names})
+                             .values_list(field_name, flat=True))
+    storage = Plant._meta.get_field('image').storage
+    for name in names:
+        storage.delete(name)
+    return len(names)
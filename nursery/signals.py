@@ -0,0 +1,149 @@
+import contextlib
+import contextvars
+from django.contrib.auth.models import Group, Permission, User
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from .backends import invalidate_all_permissions, invalidate_user_permissions
+from .dashboard import invalidate_location_dashboard
+from .events import plant_instance_event, publish
+from .models import Location, Plant, PlantInstance
+from .photos import PHOTO_FIELDS, VARIANTS, delete_unreferenced_files
+from .tasks import enqueue
+
+# Keep the shared permission cache (nursery.backends.CachedModelBackend) in step with the auth tables,
+# and the cached location dashboard (nursery.dashboard) and live event streams (nursery.events)
+# in step with each user's plants. Uploaded photos get their variants generated in the background.
+
+M2M_ACTIONS = ('post_add', 'post_remove', 'post_clear')
+
+# Set while nursery.bulk changes many rows: it notifies each owner once per operation, so the
+# per-row dashboard and event stream handlers below do nothing.
+_notifications_paused = contextvars.ContextVar('notifications_paused', default=False)
+
+
+@contextlib.contextmanager
+def per_row_notifications_paused():
+    token = _notifications_paused.set(True)
+    try:
+        yield
+    finally:
+        _notifications_paused.reset(token)
+
+
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=User.groups.through)
+def user_permissions_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """Invalidates users whose direct permissions or group memberships changed."""
+    if action not in M2M_ACTIONS:
+        return
+    if not reverse:
+        invalidate_user_permissions(instance.pk)
+    elif action == 'post_clear':
+        # pk_set is None after clear(), so we no longer know which users were affected
+        invalidate_all_permissions()
+    else:
+        for user_id in pk_set:
+            invalidate_user_permissions(user_id)
+
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def group_permissions_changed(sender, action, **kwargs):
+    """A group's permissions apply to all of its members, so invalidate everyone."""
+    if action in M2M_ACTIONS:
+        invalidate_all_permissions()
+
+
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=Permission)
+@receiver(post_save, sender=Permission)
+def group_or_permission_changed(sender, **kwargs):
+    """Superusers' cached permissions are every Permission, so new ones (e.g. from migrate) count too."""
+    invalidate_all_permissions()
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, update_fields=None, **kwargs):
+    """is_active and is_superuser affect which permissions a user has."""
+    # logging in only updates last_login
+    if not created and update_fields != frozenset(['last_login']):
+        invalidate_user_permissions(instance.pk)
+
+
+def owners(instance, field_name):
+    """Returns the ids of the instance's current owner and of the owner it was loaded with."""
+    user_ids = {getattr(instance, field_name + '_id'), getattr(instance, f'_loaded_{field_name}_id', None)}
+    # after this save, the current owner is the one to compare against
+    setattr(instance, f'_loaded_{field_name}_id', getattr(instance, field_name + '_id'))
+    user_ids.discard(None)
+    return user_ids
+
+
+@receiver(post_save, sender=PlantInstance)
+@receiver(post_delete, sender=PlantInstance)
+def plant_instance_changed(sender, instance, signal, **kwargs):
+    """Recompute the location dashboards of the plant's owners and tell their open streams.
+
+    A plant moved to another customer is reported as deleted to its previous owner.
+    Runs after commit, so nothing recomputes (and caches) a dashboard from the old rows.
+    """
+    if _notifications_paused.get():
+        return
+    user_ids = owners(instance, 'customer')
+    customer_id = instance.customer_id
+    event_type = 'deleted' if signal is post_delete else 'changed'
+    event = plant_instance_event(instance)
+
+    def notify():
+        for user_id in user_ids:
+            invalidate_location_dashboard(user_id)
+            publish(user_id, event_type if user_id == customer_id else 'deleted', **event)
+    transaction.on_commit(notify)
+
+
+@receiver(post_save, sender=Location)
+@receiver(post_delete, sender=Location)
+def location_changed(sender, instance, **kwargs):
+    if _notifications_paused.get():
+        return
+    user_ids = owners(instance, 'user')
+
+    def notify():
+        for user_id in user_ids:
+            invalidate_location_dashboard(user_id)
+    transaction.on_commit(notify)
+
+
+@receiver(post_save, sender=Plant)
+@receiver(post_save, sender=PlantInstance)
+def photo_saved(sender, instance, **kwargs):
+    """Queues variant generation for a new photo, and removes the files of a replaced or removed one."""
+    unused = []
+    loaded, current = getattr(instance, '_loaded_image', ''), instance.image.name or ''
+    if loaded and loaded != current:
+        unused.append(loaded)
+    instance._loaded_image = current
+
+    if instance.image_variants_pending:
+        model_name = sender._meta.model_name
+        # one task per uploaded photo, so a replacement isn't deduplicated against a running task
+        dedup_key = f'photo-variants:{model_name}:{instance.pk}:{instance.image.name}'
+        transaction.on_commit(lambda: enqueue('nursery.jobs.generate_photo_variants', model_name,
+                                              str(instance.pk), dedup_key=dedup_key))
+    elif not instance.image and instance.image_variants_of:
+        unused += [getattr(instance, field_name).name for field_name in VARIANTS]
+        cleared = dict.fromkeys([*VARIANTS, 'image_variants_of'], '')
+        sender.objects.filter(pk=instance.pk).update(**cleared)
+        for field_name, value in cleared.items():
+            setattr(instance, field_name, value)
+    # the variants of a replaced photo are removed by generate_photo_variants once the new ones exist
+    if unused:
+        transaction.on_commit(lambda: delete_unreferenced_files(unused))
+
+
+@receiver(post_delete, sender=Plant)
+@receiver(post_delete, sender=PlantInstance)
+def photo_deleted(sender, instance, **kwargs):
+    names = [getattr(instance, field_name).name for field_name in PHOTO_FIELDS]
+    if any(names):
+        transaction.on_commit(lambda: delete_unreferenced_files(names))
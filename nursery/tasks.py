@@ -0,0 +1,122 @@
+import datetime
+import logging
+import traceback
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .models import Task
+
+logger = logging.getLogger(__name__)
+
+# Seconds a claimed task stays invisible to other workers before it's treated as abandoned.
+DEFAULT_VISIBILITY_TIMEOUT = 300
+
+
+def enqueue(name, *args, priority=0, dedup_key=None, max_attempts=3, delay=None, **kwargs):
+    """Stores a task to run `name` (a dotted path to a function) with the given arguments.
+
+    If dedup_key is given and a queued or running task already has that key, the existing
+    task is returned instead of creating a duplicate.
+    """
+    available_at = timezone.now() + (delay or datetime.timedelta())
+    if dedup_key is not None:
+        existing = Task.objects.filter(dedup_key=dedup_key, status__in=['q', 'r']).first()
+        if existing:
+            return existing
+    try:
+        with transaction.atomic():
+            return Task.objects.create(name=name, args=list(args), kwargs=kwargs, priority=priority,
+                                       dedup_key=dedup_key, max_attempts=max_attempts,
+                                       available_at=available_at)
+    except IntegrityError:
+        # another process enqueued the same dedup key between our check and insert
+        existing = Task.objects.filter(dedup_key=dedup_key, status__in=['q', 'r']).first()
+        if existing is None:
+            raise
+        return existing
+
+
+def claim(worker_id, limit=1, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT):
+    """Claims up to `limit` runnable tasks for worker_id and returns them, highest priority first.
+
+    A task is runnable if it is queued and available, or running with an expired lock and
+    attempts left. Each task is claimed with a conditional UPDATE so two workers never get
+    the same task.
+    """
+    now = timezone.now()
+    # a worker that died (or overran its lock) on the last attempt doesn't get another one
+    abandoned = (
+        Task.objects.filter(status='r', locked_until__lt=now, attempts__gte=F('max_attempts'))
+        .update(status='f', locked_until=None, finished=now,
+                last_error='Lock expired before the last attempt finished')
+    )
+    if abandoned:
+        logger.warning("Marked %d abandoned task(s) failed after their last attempt", abandoned)
+    runnable = (
+        Q(status='q', available_at__lte=now)
+        | Q(status='r', locked_until__lt=now, attempts__lt=F('max_attempts'))
+    )
+    candidates = (
+        Task.objects.filter(runnable)
+        .order_by('-priority', 'available_at')
+        .values_list('id', 'status', 'locked_until')[:limit * 2]
+    )
+    claimed = []
+    for task_id, status, locked_until in candidates:
+        updated = (
+            Task.objects.filter(id=task_id, status=status, locked_until=locked_until)
+            .update(status='r', attempts=F('attempts') + 1, locked_by=worker_id,
+                    locked_until=now + datetime.timedelta(seconds=visibility_timeout))
+        )
+        if updated:
+            claimed.append(task_id)
+        if len(claimed) == limit:
+            break
+    return list(Task.objects.filter(id__in=claimed).order_by('-priority', 'available_at'))
+
+
+def extend(task_ids, worker_id, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT):
+    """Pushes back the lock on tasks this worker is still running."""
+    locked_until = timezone.now() + datetime.timedelta(seconds=visibility_timeout)
+    return (
+        Task.objects.filter(id__in=task_ids, status='r', locked_by=worker_id)
+        .update(locked_until=locked_until)
+    )
+
+
+def complete(task, worker_id):
+    """Marks a task done, unless another worker took it over after the lock expired."""
+    return (
+        Task.objects.filter(id=task.id, status='r', locked_by=worker_id)
+        .update(status='d', locked_until=None, finished=timezone.now(), last_error='')
+    )
+
+
+def fail(task, worker_id, error):
+    """Records a failed attempt and either schedules a retry with backoff or marks the task failed."""
+    if task.attempts >= task.max_attempts:
+        return (
+            Task.objects.filter(id=task.id, status='r', locked_by=worker_id)
+            .update(status='f', locked_until=None, finished=timezone.now(), last_error=error)
+        )
+    # exponential backoff: 10s, 20s, 40s, ...
+    retry_at = timezone.now() + datetime.timedelta(seconds=10 * 2 ** (task.attempts - 1))
+    return (
+        Task.objects.filter(id=task.id, status='r', locked_by=worker_id)
+        .update(status='q', locked_until=None, available_at=retry_at, last_error=error)
+    )
+
+
+def execute(name, args, kwargs):
+    """Imports and calls a task function. Runs inside a pool thread or process."""
+    from django.db import close_old_connections, connections
+    try:
+        close_old_connections()
+        import_string(name)(*args, **kwargs)
+        return None
+    except Exception:
+        return traceback.format_exc()
+    finally:
+        # pool threads don't go through request_finished, so close their connections here
+        connections.close_all()
@@ -1,3 +1,745 @@
-from django.test import TestCase
+import atexit
+import asyncio
+import datetime
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from unittest import mock
+from django.contrib.auth.models import Group, Permission, User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, OperationalError, connection
+from django.db.models.query import QuerySet
+from django.db.models.signals import post_save
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from PIL import Image
+from nursery import bulk, jobs, metrics, photos, tasks, views
+from nursery.dashboard import location_dashboard
+from nursery.forms import BulkDeleteForm
+from nursery.garden_archive import restore_garden_archive, stream_garden_archive
+from nursery.models import ConcurrentUpdateError, Location, Plant, PlantInstance, Task
 
-# Create your tests here.
+# Keep tests out of the real cache directory, and each test out of the last one's entries.
+TEST_CACHE_DIR = tempfile.mkdtemp(prefix='petrichor-test-cache-')
+atexit.register(shutil.rmtree, TEST_CACHE_DIR, ignore_errors=True)
+TEST_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                           'LOCATION': TEST_CACHE_DIR}}
+
+
+@override_settings(CACHES=TEST_CACHES)
+class NurseryTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+
+class TaskQueueTests(NurseryTestCase):
+    def test_enqueue_with_dedup_key_returns_pending_task(self):
+        first = tasks.enqueue('nursery.jobs.send_watering_digests', dedup_key='digests')
+        second = tasks.enqueue('nursery.jobs.send_watering_digests', dedup_key='digests')
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(Task.objects.count(), 1)
+
+    def test_enqueue_with_dedup_key_after_task_finished(self):
+        first = tasks.enqueue('nursery.jobs.send_watering_digests', dedup_key='digests')
+        Task.objects.filter(pk=first.pk).update(status='d')
+        second = tasks.enqueue('nursery.jobs.send_watering_digests', dedup_key='digests')
+        self.assertNotEqual(first.pk, second.pk)
+
+    def test_claim_highest_priority_first(self):
+        low = tasks.enqueue('nursery.jobs.send_watering_digests', priority=0)
+        high = tasks.enqueue('nursery.jobs.send_watering_digests', priority=10)
+        later = tasks.enqueue('nursery.jobs.send_watering_digests', priority=10,
+                              delay=datetime.timedelta(hours=1))
+        claimed = tasks.claim('worker', limit=3)
+        self.assertEqual([task.pk for task in claimed], [high.pk, low.pk])
+        self.assertNotIn(later.pk, [task.pk for task in claimed])
+
+    def test_claimed_task_not_claimed_again(self):
+        tasks.enqueue('nursery.jobs.send_watering_digests')
+        self.assertEqual(len(tasks.claim('worker-1')), 1)
+        self.assertEqual(tasks.claim('worker-2'), [])
+
+    def test_fail_retries_with_backoff(self):
+        tasks.enqueue('nursery.jobs.send_watering_digests', max_attempts=2)
+        task = tasks.claim('worker')[0]
+        before = timezone.now()
+        tasks.fail(task, 'worker', 'boom')
+        task.refresh_from_db()
+        self.assertEqual(task.status, 'q')
+        self.assertEqual(task.last_error, 'boom')
+        self.assertGreaterEqual(task.available_at, before + datetime.timedelta(seconds=10))
+        # not runnable until the backoff is over
+        self.assertEqual(tasks.claim('worker'), [])
+
+        Task.objects.filter(pk=task.pk).update(available_at=timezone.now())
+        task = tasks.claim('worker')[0]
+        self.assertEqual(task.attempts, 2)
+        tasks.fail(task, 'worker', 'boom again')
+        task.refresh_from_db()
+        self.assertEqual(task.status, 'f')
+
+    def test_expired_lock_is_reclaimed(self):
+        tasks.enqueue('nursery.jobs.send_watering_digests')
+        task = tasks.claim('worker-1', visibility_timeout=60)[0]
+        self.assertEqual(tasks.claim('worker-2'), [])
+
+        Task.objects.filter(pk=task.pk).update(locked_until=timezone.now() - datetime.timedelta(seconds=1))
+        reclaimed = tasks.claim('worker-2')
+        self.assertEqual([t.pk for t in reclaimed], [task.pk])
+        self.assertEqual(reclaimed[0].attempts, 2)
+        # the first worker lost the task, so it can no longer complete it
+        self.assertEqual(tasks.complete(task, 'worker-1'), 0)
+        self.assertEqual(tasks.complete(reclaimed[0], 'worker-2'), 1)
+
+    def test_expired_lock_on_last_attempt_fails_task(self):
+        tasks.enqueue('nursery.jobs.send_watering_digests', max_attempts=1)
+        task = tasks.claim('worker-1')[0]
+        Task.objects.filter(pk=task.pk).update(locked_until=timezone.now() - datetime.timedelta(seconds=1))
+        with self.assertLogs('nursery.tasks', 'WARNING'):
+            self.assertEqual(tasks.claim('worker-2'), [])
+        task.refresh_from_db()
+        self.assertEqual(task.status, 'f')
+
+
+class RenewAllDueWateredTests(NurseryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('gardener', password='password')
+        plant = Plant.objects.create(user=self.user, scientific_name='Ficus lyrata', water='r', sun='p')
+        location = Location.objects.create(user=self.user, name='Kitchen')
+        self.dry = PlantInstance.objects.create(customer=self.user, plant=plant, location=location,
+                                                nickname='Figgy', due_watered=datetime.date.today())
+        self.client.force_login(self.user)
+
+    def test_queues_one_renewal_and_job_renews_dry_plants(self):
+        url = reverse('renew-all-due-watered')
+        self.assertRedirects(self.client.post(url), reverse('my-plants'))
+        self.client.post(url)
+        task = Task.objects.get()
+        self.assertEqual(task.name, 'nursery.jobs.renew_due_watered')
+
+        self.assertEqual(import_string(task.name)(*task.args, **task.kwargs), 1)
+        self.dry.refresh_from_db()
+        self.assertEqual(self.dry.due_watered, datetime.date.today() + datetime.timedelta(weeks=2))
+        self.assertEqual(self.dry.version, 2)
+
+
+class CachedPermissionTests(NurseryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('gardener')
+        self.permission = Permission.objects.get(codename='add_plant')
+        self.group = Group.objects.create(name='gardeners')
+
+    def fresh_user(self):
+        # a new user object, as on the next request, so only the shared cache carries permissions over
+        return User.objects.get(pk=self.user.pk)
+
+    def test_revoked_user_permission_takes_effect(self):
+        self.user.user_permissions.add(self.permission)
+        self.assertTrue(self.fresh_user().has_perm('nursery.add_plant'))
+        self.user.user_permissions.remove(self.permission)
+        self.assertFalse(self.fresh_user().has_perm('nursery.add_plant'))
+
+    def test_removed_group_membership_takes_effect(self):
+        self.group.permissions.add(self.permission)
+        self.user.groups.add(self.group)
+        self.assertTrue(self.fresh_user().has_perm('nursery.add_plant'))
+        self.user.groups.remove(self.group)
+        self.assertFalse(self.fresh_user().has_perm('nursery.add_plant'))
+
+    def test_revoked_group_permission_takes_effect(self):
+        self.group.permissions.add(self.permission)
+        self.user.groups.add(self.group)
+        self.assertTrue(self.fresh_user().has_perm('nursery.add_plant'))
+        self.group.permissions.remove(self.permission)
+        self.assertFalse(self.fresh_user().has_perm('nursery.add_plant'))
+
+    def test_new_permission_granted_to_superusers(self):
+        User.objects.filter(pk=self.user.pk).update(is_superuser=True)
+        # has_perm() short-circuits for superusers, but get_all_permissions() uses the cache
+        self.assertNotIn('nursery.water_plant', self.fresh_user().get_all_permissions())
+        Permission.objects.create(codename='water_plant', name='Can water plant',
+                                  content_type=self.permission.content_type)
+        self.assertIn('nursery.water_plant', self.fresh_user().get_all_permissions())
+
+    def test_cached_permission_checks_run_no_queries(self):
+        self.user.user_permissions.add(self.permission)
+        self.fresh_user().has_perm('nursery.add_plant')
+        user = self.fresh_user()
+        with self.assertNumQueries(0):
+            self.assertTrue(user.has_perm('nursery.add_plant'))
+            self.assertFalse(user.has_perm('nursery.delete_plant'))
+
+
+class LocationDashboardTests(NurseryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.plant = Plant.objects.create(scientific_name='Ficus lyrata', water='r', sun='p')
+        self.alice_kitchen = Location.objects.create(user=self.alice, name='Kitchen')
+        self.bob_kitchen = Location.objects.create(user=self.bob, name='Kitchen')
+        PlantInstance.objects.create(customer=self.alice, plant=self.plant, location=self.alice_kitchen,
+                                     nickname='Figgy', due_watered=datetime.date.today())
+
+    def totals(self, user):
+        return {row['name']: (row['total'], row['due_today']) for row in location_dashboard(user)}
+
+    def test_cached_until_plants_change(self):
+        self.assertEqual(self.totals(self.alice), {'Kitchen': (1, 1)})
+        with self.assertNumQueries(0):
+            self.assertEqual(self.totals(self.alice), {'Kitchen': (1, 1)})
+        with self.captureOnCommitCallbacks(execute=True):
+            PlantInstance.objects.create(customer=self.alice, plant=self.plant, location=self.alice_kitchen,
+                                         nickname='Ficus II')
+        self.assertEqual(self.totals(self.alice), {'Kitchen': (2, 1)})
+
+    def test_reassigned_plant_refreshes_both_owners(self):
+        self.assertEqual(self.totals(self.alice), {'Kitchen': (1, 1)})
+        self.assertEqual(self.totals(self.bob), {'Kitchen': (0, 0)})
+
+        plant_instance = PlantInstance.objects.get(nickname='Figgy')
+        plant_instance.customer = self.bob
+        plant_instance.location = self.bob_kitchen
+        with self.captureOnCommitCallbacks() as callbacks:
+            plant_instance.save()
+        # nothing is invalidated before the transaction commits
+        self.assertEqual(self.totals(self.alice), {'Kitchen': (1, 1)})
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.totals(self.alice), {'Kitchen': (0, 0)})
+        self.assertEqual(self.totals(self.bob), {'Kitchen': (1, 1)})
+
+
+class BulkOperationTests(NurseryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.ficus = Plant.objects.create(user=self.alice, scientific_name='Ficus lyrata', water='r', sun='p')
+        self.kitchen = Location.objects.create(user=self.alice, name='Kitchen')
+        self.porch = Location.objects.create(user=self.alice, name='Porch')
+        self.figgy = PlantInstance.objects.create(customer=self.alice, plant=self.ficus, location=self.kitchen,
+                                                  nickname='Figgy')
+
+    def test_move_plant_instances(self):
+        result = bulk.move_plant_instances(self.kitchen, self.porch)
+        self.assertTrue(result['applied'])
+        self.assertEqual(result['counts'], {'plant instances': 1})
+        self.figgy.refresh_from_db()
+        self.assertEqual(self.figgy.location, self.porch)
+        self.assertEqual(self.figgy.version, 2)
+
+    def test_move_to_other_owners_location_is_a_conflict(self):
+        bobs_kitchen = Location.objects.create(user=self.bob, name='Kitchen')
+        result = bulk.move_plant_instances(self.kitchen, bobs_kitchen)
+        self.assertFalse(result['applied'])
+        self.assertEqual(len(result['conflicts']), 1)
+        self.assertEqual(PlantInstance.objects.get().location, self.kitchen)
+
+    def test_reassign_reports_per_owner_name_conflicts(self):
+        Location.objects.create(user=self.bob, name='Kitchen')
+        Plant.objects.create(user=self.bob, scientific_name='Ficus lyrata', water='r', sun='p')
+        result = bulk.reassign_garden(self.alice, self.bob)
+        self.assertFalse(result['applied'])
+        self.assertEqual(result['conflicts'], ['bob already has a location named Kitchen',
+                                               'bob already has a plant Ficus lyrata'])
+        self.assertEqual(Location.objects.filter(user=self.alice).count(), 2)
+        self.assertEqual(Plant.objects.filter(user=self.alice).count(), 1)
+
+    def test_reassign_dry_run_leaves_database_unchanged(self):
+        result = bulk.reassign_garden(self.alice, self.bob, dry_run=True)
+        self.assertFalse(result['applied'])
+        self.assertEqual(result['conflicts'], [])
+        self.assertEqual(result['counts'], {'locations': 2, 'plants': 1, 'plant instances': 1})
+        self.assertFalse(Location.objects.filter(user=self.bob).exists())
+        self.assertFalse(PlantInstance.objects.filter(customer=self.bob).exists())
+        self.assertEqual(Location.objects.filter(version__gt=1).count(), 0)
+
+    def test_reassign_garden(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            result = bulk.reassign_garden(self.alice, self.bob)
+        self.assertTrue(result['applied'])
+        self.assertEqual(Location.objects.filter(user=self.bob).count(), 2)
+        self.assertEqual(Plant.objects.get().user, self.bob)
+        self.assertEqual(PlantInstance.objects.get().customer, self.bob)
+
+    def test_reassign_rolls_back_when_a_statement_fails(self):
+        update = QuerySet.update
+
+        def failing_update(queryset, **kwargs):
+            # the plant instances are updated last, after the locations and plants
+            if queryset.model is PlantInstance:
+                raise IntegrityError('simulated failure')
+            return update(queryset, **kwargs)
+
+        with mock.patch.object(QuerySet, 'update', failing_update):
+            with self.assertRaises(IntegrityError):
+                bulk.reassign_garden(self.alice, self.bob)
+        self.assertEqual(Location.objects.filter(user=self.alice).count(), 2)
+        self.assertEqual(Plant.objects.get().user, self.alice)
+        self.assertEqual(PlantInstance.objects.get().customer, self.alice)
+
+    def test_delete_reports_restricted_rows(self):
+        result = bulk.delete_objects(PlantInstance.objects.none(), Location.objects.filter(user=self.alice),
+                                     Plant.objects.filter(user=self.alice))
+        self.assertFalse(result['applied'])
+        self.assertEqual(result['conflicts'], ['location Kitchen still has 1 plant instance(s)',
+                                               'plant Ficus lyrata still has 1 plant instance(s)'])
+        self.assertEqual(Location.objects.count(), 2)
+
+    def test_delete_plant_instances_with_their_location_and_plant(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            result = bulk.delete_objects(PlantInstance.objects.filter(customer=self.alice),
+                                         Location.objects.filter(pk=self.kitchen.pk),
+                                         Plant.objects.filter(user=self.alice))
+        self.assertTrue(result['applied'])
+        self.assertEqual(result['counts'], {'plant instances': 1, 'locations': 1, 'plants': 1})
+        self.assertFalse(PlantInstance.objects.exists())
+        self.assertEqual(list(Location.objects.all()), [self.porch])
+        # owners are notified once for the whole operation, not once per deleted row
+        self.assertEqual(len(callbacks), 1)
+
+    def test_delete_dry_run_leaves_database_unchanged(self):
+        result = bulk.delete_objects(PlantInstance.objects.filter(customer=self.alice),
+                                     Location.objects.filter(pk=self.kitchen.pk), Plant.objects.none(),
+                                     dry_run=True)
+        self.assertFalse(result['applied'])
+        self.assertEqual(result['counts'], {'plant instances': 1, 'locations': 1, 'plants': 0})
+        self.assertTrue(PlantInstance.objects.exists())
+        self.assertEqual(Location.objects.count(), 2)
+
+    def test_delete_form_selects_by_customer(self):
+        staff = User.objects.create_user('staff', is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.post(reverse('staff-bulk-delete'), {
+            'customer': self.alice.pk, 'delete_locations': 'on', 'delete_plants': 'on'})
+        self.assertEqual(response.context['result']['counts'],
+                         {'plant instances': 1, 'locations': 2, 'plants': 1})
+        self.assertFalse(Location.objects.filter(user=self.alice).exists())
+
+    def test_delete_form_requires_customer_or_location(self):
+        self.assertFalse(BulkDeleteForm({}).is_valid())
+        self.assertFalse(BulkDeleteForm({'customer': self.alice.pk, 'location': self.kitchen.pk}).is_valid())
+        form = BulkDeleteForm({'location': self.kitchen.pk})
+        self.assertTrue(form.is_valid())
+        instances, locations, plants = form.querysets()
+        self.assertEqual(list(instances), [self.figgy])
+        self.assertFalse(locations.exists())
+
+
+class GardenArchiveTests(NurseryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.staff = User.objects.create_user('staff', is_staff=True)
+        self.alice = User.objects.create_user('alice')
+        # a staff template plant used by one of alice's plants
+        self.template = Plant.objects.create(user=self.staff, scientific_name='Monstera deliciosa',
+                                             water='r', sun='p')
+        ficus = Plant.objects.create(user=self.alice, scientific_name='Ficus lyrata', water='r', sun='p')
+        kitchen = Location.objects.create(user=self.alice, name='Kitchen')
+        Location.objects.create(user=self.alice, name='Porch')
+        PlantInstance.objects.create(customer=self.alice, plant=ficus, location=kitchen, nickname='Figgy',
+                                     due_watered=datetime.date(2026, 1, 1))
+        PlantInstance.objects.create(customer=self.alice, plant=self.template, location=kitchen,
+                                     nickname='Monty')
+
+    def export(self, user):
+        return io.BytesIO(b''.join(stream_garden_archive(user)))
+
+    def garden(self, user):
+        return sorted(PlantInstance.objects.filter(customer=user)
+                      .values_list('nickname', 'plant__scientific_name', 'plant__user__username', 'location__name'))
+
+    def test_restore_into_new_user(self):
+        carol = User.objects.create_user('carol')
+        counts = restore_garden_archive(self.export(self.alice), carol)
+        self.assertEqual(counts, {'locations': 2, 'plants': 1, 'plant instances': 2})
+        self.assertEqual(self.garden(carol), [('Figgy', 'Ficus lyrata', 'carol', 'Kitchen'),
+                                              ('Monty', 'Monstera deliciosa', 'staff', 'Kitchen')])
+        self.assertEqual(PlantInstance.objects.get(customer=carol, nickname='Figgy').due_watered,
+                         datetime.date(2026, 1, 1))
+
+    def test_restore_into_existing_user_renames_clashes(self):
+        counts = restore_garden_archive(self.export(self.alice), self.alice)
+        self.assertEqual(counts, {'locations': 2, 'plants': 1, 'plant instances': 2})
+        self.assertEqual(sorted(Location.objects.filter(user=self.alice).values_list('name', flat=True)),
+                         ['Kitchen', 'Kitchen (2)', 'Porch', 'Porch (2)'])
+        self.assertEqual(self.garden(self.alice), [
+            ('Figgy', 'Ficus lyrata', 'alice', 'Kitchen'),
+            ('Figgy (2)', 'Ficus lyrata (2)', 'alice', 'Kitchen (2)'),
+            ('Monty', 'Monstera deliciosa', 'staff', 'Kitchen'),
+            ('Monty (2)', 'Monstera deliciosa', 'staff', 'Kitchen (2)'),
+        ])
+
+    def test_missing_external_plant_is_restored_as_users_own(self):
+        archive = self.export(self.alice)
+        # as if restoring into another database, where the staff template doesn't exist
+        Plant.objects.filter(pk=self.template.pk).update(scientific_name='Something else')
+        carol = User.objects.create_user('carol')
+        counts = restore_garden_archive(archive, carol)
+        self.assertEqual(counts['plants'], 2)
+        self.assertIn(('Monty', 'Monstera deliciosa', 'carol', 'Kitchen'), self.garden(carol))
+
+    def test_unresolvable_plant_fails_restore(self):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as f:
+            f.writestr('manifest.json', json.dumps({'version': 1}))
+            f.writestr('locations.jsonl', '')
+            f.writestr('plants.jsonl', '')
+            f.writestr('plantinstances.jsonl', json.dumps({
+                'id': 'b9a3bb33-5c43-4a05-9f8e-2b3fcdc4c8f5', 'plant_id': 9999, 'location_id': None,
+                'nickname': 'Lost', 'purchased': None, 'due_watered': None}) + '\n')
+        carol = User.objects.create_user('carol')
+        with self.assertRaisesMessage(ValueError, 'ids 9999'):
+            restore_garden_archive(archive, carol)
+        self.assertFalse(PlantInstance.objects.filter(customer=carol).exists())
+
+    async def test_export_streams_asynchronously_under_asgi(self):
+        await self.async_client.aforce_login(self.alice)
+        response = await self.async_client.get(reverse('my-garden-export'))
+        self.assertTrue(response.is_async)
+        content = b''.join([chunk async for chunk in response.streaming_content])
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            self.assertEqual(len(archive.read('plantinstances.jsonl').splitlines()), 2)
+
+
+class WateringEventsTests(NurseryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('gardener')
+
+    def test_no_stream_under_wsgi(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('my-plant-events')).status_code, 204)
+        self.assertNotContains(self.client.get(reverse('my-plants')), 'EventSource')
+        self.assertNotContains(self.client.get(reverse('my-due-watered')), 'EventSource')
+
+    async def test_stream_under_asgi(self):
+        await self.async_client.aforce_login(self.user)
+        self.assertContains(await self.async_client.get(reverse('my-plants')), 'EventSource')
+        self.assertContains(await self.async_client.get(reverse('my-due-watered')), 'EventSource')
+
+        response = await self.async_client.get(reverse('my-plant-events'))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        first = await asyncio.wait_for(anext(stream), 5)
+        self.assertEqual(first, b'retry: 5000\n\n')
+        await stream.aclose()
+
+    def test_due_check_is_spread_after_midnight(self):
+        midnight = datetime.datetime(2026, 1, 2)
+        for _ in range(20):
+            due_check = views.next_due_check(datetime.date(2026, 1, 1))
+            self.assertGreaterEqual(due_check, midnight)
+            self.assertLessEqual(due_check, midnight + datetime.timedelta(seconds=views.EVENT_STREAM_DUE_JITTER))
+
+    async def test_stream_sends_due_events_after_due_check(self):
+        plant = await Plant.objects.acreate(scientific_name='Ficus lyrata', water='r', sun='p')
+        await PlantInstance.objects.acreate(customer=self.user, plant=plant, nickname='Figgy',
+                                            due_watered=datetime.date.today())
+        checks = [datetime.datetime.now() - datetime.timedelta(seconds=1), datetime.datetime.max]
+        with mock.patch('nursery.views.next_due_check', side_effect=checks):
+            stream = views.watering_event_stream(self.user)
+            self.assertEqual(await anext(stream), 'retry: 5000\n\n')
+            self.assertTrue((await asyncio.wait_for(anext(stream), 5)).startswith('event: due\n'))
+            await stream.aclose()
+
+
+class MetricsTests(NurseryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.metrics_dir = tempfile.mkdtemp(prefix='petrichor-test-metrics-')
+        self.addCleanup(shutil.rmtree, self.metrics_dir, ignore_errors=True)
+
+    def write_snapshot(self, pid, renewals, overdue, age=0):
+        snapshot = {
+            metrics.RENEWALS.name: dict(metrics.RENEWALS.snapshot(), samples=[[[], renewals]]),
+            metrics.OVERDUE_PLANT_INSTANCES.name: dict(metrics.OVERDUE_PLANT_INSTANCES.snapshot(),
+                                                       samples=[[[], overdue]]),
+        }
+        path = os.path.join(self.metrics_dir, f'{pid}.json')
+        with open(path, 'w') as f:
+            json.dump(snapshot, f)
+        mtime = os.path.getmtime(path) - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_collect_adds_counters_of_live_processes_only(self):
+        own = sum(value for key, value in metrics.RENEWALS.snapshot()['samples'])
+        metrics.OVERDUE_PLANT_INSTANCES.set(3)
+        self.write_snapshot(999998, renewals=5, overdue=50)
+        stale = self.write_snapshot(999999, renewals=7, overdue=70, age=3600)
+
+        with self.settings(METRICS_DIR=self.metrics_dir):
+            collected = metrics.REGISTRY.collect()
+        self.assertEqual(collected[metrics.RENEWALS.name]['samples'], [[[], own + 5]])
+        # gauges come from this process only, not the largest (or a stale) snapshot
+        self.assertEqual(collected[metrics.OVERDUE_PLANT_INSTANCES.name]['samples'], [[[], 3]])
+        self.assertFalse(os.path.exists(stale))
+
+    def test_forked_process_starts_from_empty_samples(self):
+        metrics.RENEWALS.inc()
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.write(write, json.dumps(metrics.RENEWALS.snapshot()['samples']).encode())
+            os._exit(0)
+        os.close(write)
+        os.waitpid(pid, 0)
+        with os.fdopen(read) as f:
+            self.assertEqual(json.load(f), [])
+        self.assertNotEqual(metrics.RENEWALS.snapshot()['samples'], [])
+
+    def queries_of(self, view):
+        return sum(value for key, value in metrics.DB_QUERIES.snapshot()['samples'] if key == [view])
+
+    def test_query_metrics_under_wsgi(self):
+        self.client.force_login(User.objects.create_user('gardener'))
+        before = self.queries_of('my-plants')
+        self.client.get(reverse('my-plants'))
+        self.assertGreater(self.queries_of('my-plants'), before)
+
+    async def test_query_metrics_under_asgi(self):
+        await self.async_client.aforce_login(await User.objects.acreate(username='gardener'))
+        before = self.queries_of('my-plants')
+        await self.async_client.get(reverse('my-plants'))
+        self.assertGreater(self.queries_of('my-plants'), before)
+
+    def test_metrics_view_requires_staff_or_token(self):
+        # a reverse proxy on the same host makes every request come from 127.0.0.1
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='127.0.0.1').status_code, 404)
+        with self.settings(METRICS_TOKEN='s3cret'):
+            self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong').status_code, 404)
+            self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer s3cret').status_code, 200)
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        self.assertContains(self.client.get(reverse('metrics')), 'nursery_request_duration_seconds')
+
+
+class VersionedModelTests(NurseryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.location = Location.objects.create(name='Kitchen')
+
+    def test_save_bumps_version(self):
+        self.assertEqual(self.location.version, 1)
+        self.location.name = 'Porch'
+        self.location.save()
+        self.assertEqual(self.location.version, 2)
+        self.location.save(update_fields=['name'])
+        self.assertEqual(Location.objects.get().version, 3)
+        self.assertEqual(self.location.version, 3)
+
+    def test_save_bumps_version_without_extra_queries(self):
+        seen = []
+
+        def record(sender, instance, **kwargs):
+            seen.append(instance.version)
+
+        post_save.connect(record, sender=Location)
+        self.addCleanup(post_save.disconnect, record, sender=Location)
+        self.location.name = 'Porch'
+        with CaptureQueriesContext(connection) as queries:
+            self.location.save()
+        self.assertEqual([query['sql'].split()[0] for query in queries], ['UPDATE'])
+        self.assertEqual(seen, [2])
+        self.assertEqual(Location.objects.get().version, 2)
+
+    def test_save_versioned_detects_earlier_save(self):
+        stale = Location.objects.get()
+        self.location.name = 'Porch'
+        self.location.save()
+        stale.name = 'Hallway'
+        with self.assertRaises(ConcurrentUpdateError):
+            stale.save_versioned(['name'])
+        self.assertEqual(Location.objects.get().name, 'Porch')
+
+    def test_save_versioned_only_writes_given_fields(self):
+        self.location.name = 'Porch'
+        with CaptureQueriesContext(connection) as queries:
+            self.location.save_versioned(['name'])
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"name"', updates[0])
+        self.assertNotIn('"user_id"', updates[0])
+        self.assertEqual(self.location.version, 2)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ConcurrentRenewalTests(TransactionTestCase):
+    writers = 4
+    renewals = 10
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user('gardener')
+        plant = Plant.objects.create(user=user, scientific_name='Ficus lyrata', water='r', sun='p')
+        location = Location.objects.create(user=user, name='Kitchen')
+        self.instance = PlantInstance.objects.create(customer=user, plant=plant, location=location,
+                                                     nickname='Figgy', due_watered=datetime.date(2000, 1, 1))
+
+    def renew(self):
+        """Reads the plant and pushes its due date back a day, retrying on conflicts."""
+        for _ in range(1000):
+            try:
+                instance = PlantInstance.objects.get(pk=self.instance.pk)
+                instance.due_watered += datetime.timedelta(days=1)
+                # give other writers a chance to read the same row, as two devices would
+                time.sleep(0.001)
+                instance.save_versioned(['due_watered'])
+                return
+            except (ConcurrentUpdateError, OperationalError):
+                # OperationalError: SQLite's table lock
+                continue
+        raise AssertionError('renewal kept conflicting')
+
+    def test_parallel_versioned_renewals_lose_nothing(self):
+        start = threading.Barrier(self.writers)
+        errors = []
+
+        def writer():
+            try:
+                start.wait()
+                for _ in range(self.renewals):
+                    self.renew()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=writer) for _ in range(self.writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.instance.refresh_from_db()
+        # every renewal pushed the due date back one day, so a lost update would show as a missing day
+        expected = self.writers * self.renewals
+        self.assertEqual((self.instance.due_watered - datetime.date(2000, 1, 1)).days, expected)
+        self.assertEqual(self.instance.version, 1 + expected)
+
+
+def make_photo(name='fern.png', color='green', size=(1200, 900)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+class PhotoTests(NurseryTestCase):
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp(prefix='petrichor-test-media-')
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = self.settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.storage = Plant._meta.get_field('image').storage
+
+    def create_plant(self, name='Ficus lyrata', **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Plant.objects.create(scientific_name=name, water='r', sun='p', **kwargs)
+
+    def files(self, plant):
+        return [getattr(plant, field_name).name for field_name in photos.PHOTO_FIELDS]
+
+    def test_upload_gets_random_name_and_queues_variants(self):
+        plant = self.create_plant(image=make_photo('My Secret Garden.PNG'))
+        self.assertRegex(plant.image.name, r'^photos/[0-9a-f]{32}\.png$')
+        task = Task.objects.get()
+        self.assertEqual((task.name, task.args), ('nursery.jobs.generate_photo_variants', ['plant', str(plant.pk)]))
+
+    def test_build_variants(self):
+        plant = self.create_plant(image=make_photo())
+        names = photos.build_variants(plant)
+        self.assertEqual(set(names), {'image_thumbnail', 'image_detail', 'image_webp'})
+        with Image.open(self.storage.path(names['image_thumbnail'])) as image:
+            self.assertEqual(image.size, (160, 120))
+        with Image.open(self.storage.path(names['image_webp'])) as image:
+            self.assertEqual((image.format, image.size), ('WEBP', (800, 600)))
+        # the same content maps to the same names, so existing variants are reused
+        with mock.patch.object(self.storage, 'save') as save:
+            self.assertEqual(photos.build_variants(plant), names)
+        save.assert_not_called()
+
+    def test_generate_photo_variants(self):
+        plant = self.create_plant(image=make_photo())
+        self.assertEqual(jobs.generate_photo_variants('plant', plant.pk), 1)
+        plant.refresh_from_db()
+        self.assertFalse(plant.image_variants_pending)
+        self.assertTrue(self.storage.exists(plant.image_thumbnail.name))
+        # nothing left to do
+        self.assertEqual(jobs.generate_photo_variants('plant', plant.pk), 0)
+
+    def test_photo_replaced_while_generating_variants(self):
+        plant = self.create_plant(image=make_photo())
+        build_variants = photos.build_variants
+        generated = {}
+
+        def build_then_replace(obj):
+            generated.update(build_variants(obj))
+            Plant.objects.filter(pk=obj.pk).update(image='photos/replacement.png')
+            return generated
+
+        with mock.patch('nursery.jobs.build_variants', build_then_replace):
+            self.assertEqual(jobs.generate_photo_variants('plant', plant.pk), 0)
+        plant.refresh_from_db()
+        self.assertEqual(plant.image_thumbnail.name, '')
+        # the variants of the replaced photo aren't kept
+        self.assertFalse(any(self.storage.exists(name) for name in generated.values()))
+
+    def test_replacing_photo_deletes_old_files(self):
+        plant = self.create_plant(image=make_photo())
+        jobs.generate_photo_variants('plant', plant.pk)
+        plant = Plant.objects.get()
+        old_original, *old_variants = self.files(plant)
+
+        plant.image = make_photo(color='red')
+        with self.captureOnCommitCallbacks(execute=True):
+            plant.save()
+        self.assertFalse(self.storage.exists(old_original))
+        # still shown until the new variants are ready
+        self.assertTrue(all(self.storage.exists(name) for name in old_variants))
+
+        jobs.generate_photo_variants('plant', plant.pk)
+        self.assertFalse(any(self.storage.exists(name) for name in old_variants))
+        plant.refresh_from_db()
+        self.assertTrue(all(self.storage.exists(name) for name in self.files(plant)))
+
+    def test_clearing_photo_deletes_files(self):
+        plant = self.create_plant(image=make_photo())
+        jobs.generate_photo_variants('plant', plant.pk)
+        plant = Plant.objects.get()
+        names = self.files(plant)
+
+        plant.image = None
+        with self.captureOnCommitCallbacks(execute=True):
+            plant.save()
+        self.assertFalse(any(self.storage.exists(name) for name in names))
+        plant.refresh_from_db()
+        self.assertEqual(self.files(plant), [''] * 4)
+
+    def test_shared_variants_kept_while_referenced(self):
+        first = self.create_plant('Ficus lyrata', image=make_photo())
+        second = self.create_plant('Ficus elastica', image=make_photo())
+        jobs.generate_photo_variants('plant', first.pk)
+        jobs.generate_photo_variants('plant', second.pk)
+        first, second = Plant.objects.get(pk=first.pk), Plant.objects.get(pk=second.pk)
+        self.assertEqual(first.image_thumbnail.name, second.image_thumbnail.name)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertFalse(self.storage.exists(first.image.name))
+        self.assertTrue(all(self.storage.exists(name) for name in self.files(second)))
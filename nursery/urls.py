@@ -9,6 +9,7 @@ urlpatterns = [
     path('plantinstance/<uuid:pk>', views.PlantInstanceDetailView.as_view(), name='plant-instance-detail'),
     path('locations/', views.LocationListView.as_view(), name='locations'),
     path('mylocations/', views.LocationByUserListView.as_view(), name='my-locations'),
+    path('mylocations/dashboard/', views.LocationDashboardView.as_view(), name='my-location-dashboard'),
     path('location/<int:pk>', views.LocationDetailView.as_view(), name='location-detail'),
 ]
 
@@ -16,10 +17,17 @@ urlpatterns += [
     path('myplanttemplates/', views.PlantByUserListView.as_view(), name='user-plant-templates'),
     path('myplants/', views.PlantInstanceByUserListView.as_view(), name='my-plants'),
     path('myduewateredplants/', views.DueWateredPlantsByUserListView.as_view(), name='my-due-watered'),
+    path('myplants/events/', views.watering_events, name='my-plant-events'),
+]
+
+urlpatterns += [
+    path('mygarden/export/', views.export_garden, name='my-garden-export'),
+    path('staff/user/<int:pk>/export/', views.export_garden_staff_only, name='staff-garden-export'),
 ]
 
 urlpatterns += [
     path('plant/<uuid:pk>/renew_due_watered/', views.renew_due_watered_date, name='renew-due-watered-date'),
+    path('myplants/renew_due_watered/', views.renew_all_due_watered, name='renew-all-due-watered'),
 ]
 
 urlpatterns += [ 
@@ -41,4 +49,10 @@ urlpatterns += [
     path('staff/location/<int:pk>/update/', views.LocationUpdateStaffOnly.as_view(), name='staff-location-update'),
     path('staff/plant/<int:pk>/update/', views.PlantUpdateStaffOnly.as_view(), name='staff-plant-update'),
     path('staff/plantinstance/<uuid:pk>/update/', views.PlantInstanceUpdateStaffOnly.as_view(), name='staff-plant-instance-update'), 
-]
\ No newline at end of file
+]
+
+urlpatterns += [
+    path('staff/bulk/move/', views.StaffBulkMovePlantInstances.as_view(), name='staff-bulk-move'),
+    path('staff/bulk/reassign/', views.StaffBulkReassignGarden.as_view(), name='staff-bulk-reassign'),
+    path('staff/bulk/delete/', views.StaffBulkDelete.as_view(), name='staff-bulk-delete'),
+]
@@ -1,16 +1,35 @@
 from django.shortcuts import render, get_object_or_404, Http404
-from .models import Plant, PlantInstance, Location
+from django.views.static import serve
+from django.conf import settings
+import os
+from .models import Plant, PlantInstance, Location, ConcurrentUpdateError
+from django import forms
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
 from django.contrib.auth.models import User
 from django.views import generic
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin, UserPassesTestMixin
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseForbidden, HttpResponseRedirect, StreamingHttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
 from django.urls import reverse, reverse_lazy
+import asyncio
+import hmac
+import random
 import datetime
+import json
 from nursery.forms import RenewDueWateredDateForm
+from nursery.forms import BulkMovePlantInstancesForm, BulkReassignGardenForm, BulkDeleteForm
+from nursery import bulk
+from nursery.garden_archive import astream_garden_archive, stream_garden_archive
+from django.core.handlers.asgi import ASGIRequest
+from nursery.events import get_broker, plant_instance_event
+from nursery import metrics
+from django.http import HttpResponse
 from django.db.models import Q
+from nursery.dashboard import location_dashboard
+from nursery.tasks import enqueue
+from django.views.decorators.http import require_POST
 
 def index(request):
     """View function for home page of site."""
@@ -99,6 +118,16 @@ class LocationByUserListView(LoginRequiredMixin, generic.ListView):
             .order_by('name')
         )
 
+class LocationDashboardView(LoginRequiredMixin, generic.TemplateView):
+    """Generic class-based view showing how many plants are due to be watered in each of the current user's locations."""
+    template_name = 'nursery/location_dashboard.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        # counts come from one grouped query, cached until the user's plants change
+        context['location_list'] = location_dashboard(self.request.user)
+        return context
+
 class LocationDetailView(generic.DetailView):
     model = Location
 
@@ -130,7 +159,15 @@ class PlantInstanceStaffOnlyListView(UserPassesTestMixin, generic.ListView):
 class PlantInstanceDetailView(generic.DetailView):
     model = PlantInstance
 
-class PlantInstanceByUserListView(LoginRequiredMixin, generic.ListView):
+class LiveUpdatesMixin:
+    """Adds live_updates to the context: the live event stream (watering_events) is only served over ASGI."""
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['live_updates'] = isinstance(self.request, ASGIRequest)
+        return context
+
+class PlantInstanceByUserListView(LoginRequiredMixin, LiveUpdatesMixin, generic.ListView):
     """Generic class-based view listing watered plants by current user."""
     model = PlantInstance
     template_name = 'nursery/plantinstance_list_plants_user.html'
@@ -142,7 +179,7 @@ class PlantInstanceByUserListView(LoginRequiredMixin, generic.ListView):
             .order_by('due_watered')
         )
     
-class DueWateredPlantsByUserListView(LoginRequiredMixin,generic.ListView):
+class DueWateredPlantsByUserListView(LoginRequiredMixin, LiveUpdatesMixin, generic.ListView):
     """Generic class-based view listing plants due watered by current user."""
     model = PlantInstance
     template_name = 'nursery/plantinstance_list_due_watered_user.html'
@@ -155,6 +192,67 @@ class DueWateredPlantsByUserListView(LoginRequiredMixin,generic.ListView):
             .order_by('due_watered')
         )
 
+# Seconds between keepalive comments on an idle event stream
+EVENT_STREAM_KEEPALIVE = 25
+# Each stream sends its 'due' events at a random point this many seconds after midnight,
+# so open streams don't all query at once and their pages don't all reload at once
+EVENT_STREAM_DUE_JITTER = 15 * 60
+
+def next_due_check(today):
+    """Returns when a stream should look for plants becoming due after `today`."""
+    midnight = datetime.datetime.combine(today + datetime.timedelta(days=1), datetime.time())
+    return midnight + datetime.timedelta(seconds=random.uniform(0, EVENT_STREAM_DUE_JITTER))
+
+def format_event(event):
+    """Formats an event dict as a Server-Sent Events message."""
+    return f"event: {event['type']}\ndata: {json.dumps(event, cls=DjangoJSONEncoder)}\n\n"
+
+async def watering_event_stream(user):
+    """Yields SSE messages for a user's plant instances until the client disconnects.
+
+    Changes arrive from the event broker; shortly after midnight the stream also sends a 'due'
+    event for each plant that has become due that day. While idle it only sends a keepalive comment.
+    """
+    broker = get_broker()
+    queue = broker.subscribe(user.pk)
+    try:
+        yield 'retry: 5000\n\n'
+        due_check = next_due_check(datetime.date.today())
+        while True:
+            timeout = min(EVENT_STREAM_KEEPALIVE, (due_check - datetime.datetime.now()).total_seconds())
+            try:
+                event = await asyncio.wait_for(queue.get(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                if datetime.datetime.now() < due_check:
+                    yield ': keepalive\n\n'
+                    continue
+                today = datetime.date.today()
+                due_check = next_due_check(today)
+                async for plant_instance in PlantInstance.objects.filter(customer=user, due_watered=today):
+                    yield format_event(dict(plant_instance_event(plant_instance), type='due'))
+                continue
+            yield format_event(event)
+    finally:
+        broker.unsubscribe(user.pk, queue)
+
+async def watering_events(request):
+    """Async view streaming the current user's plant changes as Server-Sent Events.
+
+    Served through petrichor/asgi.py, an open stream is a suspended coroutine and costs no
+    queries until something changes. Under WSGI the stream would hold a worker forever, so it
+    answers 204 No Content instead, which tells EventSource clients not to reconnect.
+    """
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+    user = await request.auser()
+    if not user.is_authenticated:
+        return HttpResponseForbidden()
+    response = StreamingHttpResponse(watering_event_stream(user), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # stop proxies such as nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 @login_required
 def renew_due_watered_date(request, pk):
     """View function for renewing due watered date for a specific PlantInstance."""
@@ -170,7 +268,23 @@ def renew_due_watered_date(request, pk):
         if form.is_valid():
             # process the data in form.cleaned_data as required (here we just write it to the model due_watered field)
             plant_instance.due_watered = form.cleaned_data['renewal_date']
-            plant_instance.save()
+            # only update due_watered, and only if nobody renewed or edited the plant since the form was loaded
+            plant_instance.version = form.cleaned_data['version']
+            try:
+                plant_instance.save_versioned(['due_watered'])
+            except ConcurrentUpdateError:
+                # show the latest due date and let the user confirm their renewal again
+                plant_instance.refresh_from_db()
+                messages.warning(request, "This plant was watered or changed on another device. "
+                                          "Check the due date below and submit again to renew it.")
+                form = RenewDueWateredDateForm(initial={'renewal_date': form.cleaned_data['renewal_date'],
+                                                        'version': plant_instance.version})
+                context = {
+                    'form': form,
+                    'plant_instance': plant_instance,
+                }
+                return render(request, 'nursery/renew_due_watered_date.html', context, status=409)
+            metrics.RENEWALS.inc()
 
             # redirect to a new URL:
             return HttpResponseRedirect(reverse('my-plants'))
@@ -178,7 +292,8 @@ def renew_due_watered_date(request, pk):
     # If this is a GET (or any other method) create the default form.
     else:
         proposed_renewal_date = datetime.date.today() + datetime.timedelta(weeks=2)
-        form = RenewDueWateredDateForm(initial={'renewal_date': proposed_renewal_date})
+        form = RenewDueWateredDateForm(initial={'renewal_date': proposed_renewal_date,
+                                                'version': plant_instance.version})
 
     context = {
         'form': form,
@@ -186,12 +301,102 @@ def renew_due_watered_date(request, pk):
     }
 
     return render(request, 'nursery/renew_due_watered_date.html', context)
+
+@login_required
+@require_POST
+def renew_all_due_watered(request):
+    """View function queueing a renewal of all the current user's dry plants, two weeks ahead."""
+    renewal_date = datetime.date.today() + datetime.timedelta(weeks=2)
+    # run by the task queue (see nursery.jobs); the dedup key stops double submits queueing it twice
+    enqueue('nursery.jobs.renew_due_watered', request.user.pk, renewal_date.isoformat(),
+            priority=10, dedup_key=f'renew-due-watered:{request.user.pk}')
+    messages.success(request, f"All dry plants will be renewed until {renewal_date} in a moment.")
+    return HttpResponseRedirect(reverse('my-plants'))
  
+def garden_export_response(request, user):
+    """Streams a zip archive of the user's garden, built while it is sent."""
+    filename = f'garden-{user.get_username()}-{datetime.date.today()}.zip'
+    # under ASGI, a sync iterator would be read into a list before anything is sent
+    chunks = astream_garden_archive(user) if isinstance(request, ASGIRequest) else stream_garden_archive(user)
+    response = StreamingHttpResponse(chunks, content_type='application/zip')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+@login_required
+def export_garden(request):
+    """View function for downloading the current user's locations, plants and plant instances."""
+    return garden_export_response(request, request.user)
+
+@login_required
+def export_garden_staff_only(request, pk):
+    """View function for staff to download any user's garden."""
+    if not request.user.is_staff:
+        raise Http404
+    return garden_export_response(request, get_object_or_404(User, pk=pk))
+
+def metrics_allowed(request):
+    """True for staff, for requests with the METRICS_TOKEN bearer token, and from METRICS_ALLOWED_IPS."""
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    authorization = request.headers.get('Authorization', '')
+    return (
+        request.user.is_staff
+        or bool(token) and hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode())
+        or request.META.get('REMOTE_ADDR') in getattr(settings, 'METRICS_ALLOWED_IPS', [])
+    )
+
+def metrics_view(request):
+    """View function exposing the metrics of all worker processes in the Prometheus text format."""
+    if not metrics_allowed(request):
+        raise Http404
+    metrics.refresh_business_gauges()
+    return HttpResponse(metrics.render(metrics.REGISTRY.collect()),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def photo_variant(request, path):
+    """Serves a generated photo variant during development (only), with the cache headers the
+    web server sends in production: variant names are content hashes, so they never change."""
+    response = serve(request, path, document_root=os.path.join(settings.MEDIA_ROOT, 'variants'))
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
 ## ***** CRUD Operations ***** ##
 
+class VersionedUpdateMixin:
+    """Mixin for UpdateViews of versioned models (see VersionedModel).
+
+    Saves only the fields the user changed, and only if nobody else saved the object since the
+    form was loaded. Otherwise the form is shown again (409) with the current values and a new
+    version, so submitting it again overwrites them deliberately.
+    """
+
+    def get_form(self, form_class=None):
+        form = super().get_form(form_class)
+        form.fields['version'] = forms.IntegerField(widget=forms.HiddenInput, initial=self.object.version)
+        return form
+
+    def form_valid(self, form):
+        self.object = form.instance
+        self.object.version = form.cleaned_data['version']
+        fields = [name for name in form.changed_data if name != 'version']
+        if fields:
+            try:
+                self.object.save_versioned(fields)
+            except ConcurrentUpdateError:
+                return self.form_conflict(form, fields)
+        return HttpResponseRedirect(self.get_success_url())
+
+    def form_conflict(self, form, fields):
+        current = self.get_queryset().get(pk=self.object.pk)
+        form.data = form.data.copy()
+        form.data['version'] = current.version
+        changes = ', '.join(f'{form.fields[name].label}: {getattr(current, name)}' for name in fields)
+        form.add_error(None, f"This was changed by someone else while you were editing (now {changes}). "
+                             "Submit again to replace it with your values.")
+        return self.render_to_response(self.get_context_data(form=form), status=409)
+
 class PlantCreate(LoginRequiredMixin, PermissionRequiredMixin, CreateView): 
     model = Plant 
-    fields = ['scientific_name', 'common_name','water', 'sun', 'description', 'care_tips'] 
+    fields = ['scientific_name', 'common_name','water', 'sun', 'description', 'care_tips', 'image'] 
     initial = {'water': 'r', 'sun': 'p',}
     permission_required = 'nursery.add_plant'
 
@@ -200,9 +405,9 @@ class PlantCreate(LoginRequiredMixin, PermissionRequiredMixin, CreateView):
         form.instance.user = self.request.user
         return super().form_valid(form)
 
-class PlantUpdate(LoginRequiredMixin, PermissionRequiredMixin, UpdateView): 
+class PlantUpdate(LoginRequiredMixin, PermissionRequiredMixin, VersionedUpdateMixin, UpdateView): 
     model = Plant 
-    fields = ['scientific_name', 'common_name','water', 'sun', 'description', 'care_tips'] 
+    fields = ['scientific_name', 'common_name','water', 'sun', 'description', 'care_tips', 'image'] 
     permission_required = 'nursery.change_plant'
     
     def get_queryset(self):
@@ -211,9 +416,9 @@ class PlantUpdate(LoginRequiredMixin, PermissionRequiredMixin, UpdateView):
         # Further filter the queryset to include only objects created by the current user
         return queryset.filter(user=self.request.user)
 
-class PlantUpdateStaffOnly(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
+class PlantUpdateStaffOnly(LoginRequiredMixin, UserPassesTestMixin, VersionedUpdateMixin, UpdateView):
     model = Plant
-    fields = ['scientific_name', 'user', 'common_name','water', 'sun', 'description', 'care_tips'] 
+    fields = ['scientific_name', 'user', 'common_name','water', 'sun', 'description', 'care_tips', 'image'] 
     permission_required = 'nursery.change_plant'
 
 
@@ -245,7 +450,7 @@ class PlantDelete(PermissionRequiredMixin, DeleteView):
 
 class PlantInstanceCreate(LoginRequiredMixin, PermissionRequiredMixin, CreateView): 
     model = PlantInstance 
-    fields = ['plant', 'nickname', 'location', 'purchased', 'due_watered']
+    fields = ['plant', 'nickname', 'location', 'purchased', 'due_watered', 'image']
     proposed_due_watered_date = datetime.date.today() + datetime.timedelta(weeks=2) 
     initial = {'purchased': datetime.date.today(),
                'due_watered': proposed_due_watered_date}
@@ -269,7 +474,7 @@ class PlantInstanceCreate(LoginRequiredMixin, PermissionRequiredMixin, CreateVie
 
 class PlantInstanceCreateFromPlant(LoginRequiredMixin, PermissionRequiredMixin, CreateView):
     model = PlantInstance 
-    fields = ['plant', 'nickname', 'location', 'purchased', 'due_watered']
+    fields = ['plant', 'nickname', 'location', 'purchased', 'due_watered', 'image']
     permission_required = 'nursery.add_plantinstance'
 
     # filter queryset for plant drop-down by user or staff
@@ -304,7 +509,7 @@ class PlantInstanceCreateFromPlant(LoginRequiredMixin, PermissionRequiredMixin,
     
 class PlantInstanceCreateFromLocation(LoginRequiredMixin, PermissionRequiredMixin, CreateView):
     model = PlantInstance 
-    fields = ['plant', 'nickname', 'location', 'purchased', 'due_watered']
+    fields = ['plant', 'nickname', 'location', 'purchased', 'due_watered', 'image']
     permission_required = 'nursery.add_plantinstance'
 
     # filter queryset for plant drop-down by user or staff
@@ -337,9 +542,9 @@ class PlantInstanceCreateFromLocation(LoginRequiredMixin, PermissionRequiredMixi
         form.instance.customer = self.request.user
         return super().form_valid(form)
 
-class PlantInstanceUpdate(PermissionRequiredMixin, UpdateView):
+class PlantInstanceUpdate(PermissionRequiredMixin, VersionedUpdateMixin, UpdateView):
     model = PlantInstance 
-    fields = ['plant', 'nickname', 'location', 'purchased', 'due_watered'] 
+    fields = ['plant', 'nickname', 'location', 'purchased', 'due_watered', 'image'] 
     permission_required = 'nursery.change_plantinstance' 
 
     def get_queryset(self):
@@ -348,9 +553,9 @@ class PlantInstanceUpdate(PermissionRequiredMixin, UpdateView):
         # Further filter the queryset to include only objects created by the current user
         return queryset.filter(customer=self.request.user)
 
-class PlantInstanceUpdateStaffOnly(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
+class PlantInstanceUpdateStaffOnly(LoginRequiredMixin, UserPassesTestMixin, VersionedUpdateMixin, UpdateView):
     model = PlantInstance 
-    fields = ['plant', 'customer', 'nickname', 'location', 'purchased', 'due_watered'] 
+    fields = ['plant', 'customer', 'nickname', 'location', 'purchased', 'due_watered', 'image'] 
     permission_required = 'nursery.change_plantinstance' 
 
     def test_func(self):
@@ -389,7 +594,7 @@ class LocationCreate(LoginRequiredMixin, PermissionRequiredMixin, CreateView):
         form.instance.user = self.request.user
         return super().form_valid(form)
     
-class LocationUpdate(LoginRequiredMixin, PermissionRequiredMixin, UpdateView): 
+class LocationUpdate(LoginRequiredMixin, PermissionRequiredMixin, VersionedUpdateMixin, UpdateView): 
     model = Location 
     fields = ['name',] 
     permission_required = 'nursery.change_location'
@@ -400,7 +605,7 @@ class LocationUpdate(LoginRequiredMixin, PermissionRequiredMixin, UpdateView):
         # Further filter the queryset to include only objects created by the current user
         return queryset.filter(user=self.request.user)
     
-class LocationUpdateStaffOnly(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
+class LocationUpdateStaffOnly(LoginRequiredMixin, UserPassesTestMixin, VersionedUpdateMixin, UpdateView):
     model = Location
     fields = ['name', 'user']
     permission_required = 'nursery.change_location'
@@ -429,4 +634,55 @@ class LocationDelete(PermissionRequiredMixin, DeleteView):
                 messages.error(self.request, "Error: You are not allowed to delete this Location.")
                 return HttpResponseRedirect( reverse("location-delete", kwargs={"pk": self.object.pk}) )
         except Exception as e: 
-            return HttpResponseRedirect( reverse("location-delete", kwargs={"pk": self.object.pk}) )
\ No newline at end of file
+            return HttpResponseRedirect( reverse("location-delete", kwargs={"pk": self.object.pk}) )
+
+
+## ***** Staff Bulk Operations ***** ##
+
+class StaffBulkOperationView(LoginRequiredMixin, UserPassesTestMixin, generic.FormView):
+    """Base view for staff bulk operations. Shows the counts and conflicts of a dry run or applied run."""
+    template_name = 'nursery/staff_bulk_form.html'
+    title = None
+
+    def test_func(self):
+        # test if user is staff
+        return self.request.user.is_staff
+
+    def run(self, form):
+        raise NotImplementedError
+
+    def form_valid(self, form):
+        result = self.run(form)
+        if result['applied']:
+            messages.success(self.request, f"{self.title}: done.")
+        elif result['conflicts']:
+            messages.error(self.request, f"{self.title}: nothing was changed because of conflicts.")
+        return self.render_to_response(self.get_context_data(form=form, result=result))
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['title'] = self.title
+        return context
+
+class StaffBulkMovePlantInstances(StaffBulkOperationView):
+    form_class = BulkMovePlantInstancesForm
+    title = 'Move Plant Instances'
+
+    def run(self, form):
+        return bulk.move_plant_instances(form.cleaned_data['from_location'], form.cleaned_data['to_location'],
+                                         dry_run=form.cleaned_data['dry_run'])
+
+class StaffBulkReassignGarden(StaffBulkOperationView):
+    form_class = BulkReassignGardenForm
+    title = 'Reassign Garden'
+
+    def run(self, form):
+        return bulk.reassign_garden(form.cleaned_data['from_user'], form.cleaned_data['to_user'],
+                                    dry_run=form.cleaned_data['dry_run'])
+
+class StaffBulkDelete(StaffBulkOperationView):
+    form_class = BulkDeleteForm
+    title = 'Bulk Delete'
+
+    def run(self, form):
+        return bulk.delete_objects(*form.querysets(), dry_run=form.cleaned_data['dry_run'])
@@ -0,0 +1,105 @@
+import logging
+import os
+import time
+import django
+from django.apps import apps
+from django.conf import settings
+from django.db import connections
+from django.template import engines
+from django.template.exceptions import TemplateDoesNotExist, TemplateSyntaxError
+from django.urls import get_resolver
+
+logger = logging.getLogger(__name__)
+
+
+def iter_template_names():
+    """Yields the name of every template found in the project and app template directories.
+
+    Templates shipped with Django itself (admin, auth, ...) are skipped: compiling them
+    roughly doubled warm-up time, and only the rare admin request would benefit.
+    """
+    django_dir = os.path.dirname(django.__file__) + os.sep
+    for engine in engines.all():
+        for template_dir in engine.template_dirs:
+            if str(template_dir).startswith(django_dir):
+                continue
+            for root, dirs, files in os.walk(template_dir):
+                for filename in files:
+                    if filename.endswith(('.html', '.txt')):
+                        path = os.path.join(root, filename)
+                        yield engine, os.path.relpath(path, template_dir).replace(os.sep, '/')
+
+
+def warm_templates():
+    """Compiles every template so the cached loader holds them before the first request."""
+    count = 0
+    for engine, name in iter_template_names():
+        try:
+            engine.get_template(name)
+            count += 1
+        except (TemplateDoesNotExist, TemplateSyntaxError) as e:
+            logger.warning("Could not preload template %s: %s", name, e)
+    return count
+
+
+def warm_urls():
+    """Populates the URL resolvers (including included URLconfs) and returns the number of named URLs."""
+    resolver = get_resolver()
+    # Accessing reverse_dict populates the root resolver and, through it, every included resolver.
+    names = [key for key in resolver.reverse_dict if isinstance(key, str)]
+    for prefix, namespace_resolver in resolver.namespace_dict.values():
+        namespace_resolver.reverse_dict
+    return len(names)
+
+
+def warm_models():
+    """Builds the field caches and relation trees for every installed model."""
+    models = apps.get_models()
+    for model in models:
+        model._meta.get_fields()
+        model._meta.concrete_fields
+    return len(models)
+
+
+def warm_connections():
+    """Connects to each configured database once, then closes the connection again.
+
+    This loads the database driver and checks the database is reachable. The connection
+    isn't kept: connections belong to the thread that opened them, so request threads
+    couldn't use it, and a pre-forking server (e.g. gunicorn --preload) would share it
+    between its workers. Request threads open their own (kept for CONN_MAX_AGE, if set).
+    """
+    opened = 0
+    for conn in connections.all():
+        try:
+            conn.ensure_connection()
+            opened += 1
+        except Exception as e:
+            logger.warning("Could not open database connection %s: %s", conn.alias, e)
+        finally:
+            conn.close()
+    return opened
+
+
+def warm_up(databases=True):
+    """Runs every warm-up step and returns a dict of counts and the time taken in seconds.
+
+    Pass databases=False where blocking database calls aren't allowed (e.g. at ASGI startup).
+    """
+    start = time.perf_counter()
+    stats = {
+        'models': warm_models(),
+        'urls': warm_urls(),
+        'templates': warm_templates(),
+        'connections': warm_connections() if databases else 0,
+    }
+    stats['seconds'] = time.perf_counter() - start
+    logger.info("Worker warm-up finished: %s", stats)
+    return stats
+
+
+def warm_up_if_enabled(databases=True):
+    """Calls warm_up() from the WSGI/ASGI entry points unless WARMUP_ON_STARTUP is False."""
+    if getattr(settings, 'WARMUP_ON_STARTUP', True):
+        return warm_up(databases=databases)
+    return None
@@ -14,3 +14,11 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'petrichor.settings')
 
 application = get_asgi_application()
+
+# Preload templates, URL resolvers and model metadata so the first request on a
+# fresh worker doesn't pay for them (see nursery/warmup.py). The database step is
+# skipped: ASGI servers may import this module inside the event loop, where
+# blocking database calls raise SynchronousOnlyOperation.
+from nursery.warmup import warm_up_if_enabled
+
+warm_up_if_enabled(databases=False)
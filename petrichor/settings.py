@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'nursery.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -78,9 +79,18 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Connections are closed at the end of each request by default. Under WSGI, set
+        # PETRICHOR_CONN_MAX_AGE (e.g. 60) to let each worker thread reuse its connection;
+        # keep 0 under ASGI, where Django advises against persistent connections.
+        'CONN_MAX_AGE': int(os.environ.get('PETRICHOR_CONN_MAX_AGE', 0)),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# Warm up templates, URLs and models, and check the DB connections, when a worker boots
+# (petrichor/wsgi.py and petrichor/asgi.py). Set PETRICHOR_WARMUP=0 to disable.
+WARMUP_ON_STARTUP = os.environ.get('PETRICHOR_WARMUP', '1') != '0'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -125,9 +135,51 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 LOGIN_REDIRECT_URL = '/'
 
+# Shared by every worker process on this host, so invalidating a cached entry (e.g. a
+# user's permissions) takes effect in all of them. The per-process default
+# (LocMemCache) would keep serving stale entries in the other workers. Use Redis or
+# Memcached when workers run on several hosts.
+# Cache files are pickles that are trusted when read, so the directory must only be
+# writable by the app: the default is private to the project (FileBasedCache creates it
+# with mode 0o700) and is not under MEDIA_ROOT or STATIC_ROOT.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('PETRICHOR_CACHE_DIR', os.path.join(BASE_DIR, '.cache')),
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }
+}
+
+# Cache each user's permissions across requests (invalidated by nursery/signals.py).
+# PERMISSION_CACHE_ALIAS must name a cache shared by all workers (checked at startup).
+AUTHENTICATION_BACKENDS = ['nursery.backends.CachedModelBackend']
+PERMISSION_CACHE_ALIAS = 'default'
+PERMISSION_CACHE_TIMEOUT = 60 * 60
+
+# Broker that delivers plant instance changes to the live event streams (nursery/events.py).
+# Use 'nursery.events.RedisBroker' and set NURSERY_EVENT_BROKER_URL when running several ASGI workers.
+NURSERY_EVENT_BROKER = 'nursery.events.InMemoryBroker'
+
+# Metrics exposed at /metrics (see nursery/metrics.py). Set PETRICHOR_METRICS_DIR to a directory
+# shared by all worker processes so a scrape of any worker reports the totals of all of them.
+METRICS_DIR = os.environ.get('PETRICHOR_METRICS_DIR')
+METRICS_FLUSH_INTERVAL = 10
+# snapshots not rewritten for this many seconds belong to exited workers and are removed
+METRICS_STALE_AFTER = 60
+# seconds between recomputing gauges such as the number of overdue plant instances
+METRICS_GAUGE_INTERVAL = 60
+# Who may read /metrics besides staff: a scraper sending "Authorization: Bearer <token>", and
+# clients from these addresses. Behind a reverse proxy on the same host every request comes
+# from 127.0.0.1, so only list addresses that requests can't arrive from through the proxy.
+METRICS_TOKEN = os.environ.get('PETRICHOR_METRICS_TOKEN')
+METRICS_ALLOWED_IPS = []
+
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
 
-# added when trying to configure imagefield
-#MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
-#MEDIA_URL = '/media/'
+# Uploaded plant photos and their generated variants (see nursery/photos.py)
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+MEDIA_URL = '/media/'
+
+# Uploads larger than this are streamed to a temporary file in chunks rather than held in memory
+FILE_UPLOAD_MAX_MEMORY_SIZE = 1024 * 1024
@@ -23,14 +23,25 @@ from django.views.generic import RedirectView
 # Use static() to add URL mapping to serve static files during development (only)
 from django.conf import settings
 from django.conf.urls.static import static
+from nursery.views import metrics_view, photo_variant
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('nursery/', include('nursery.urls')),
     # redirect root URL (i.e., 127.0.0.1:8000) to the URL 127.0.0.1:8000/nursery/
     path('', RedirectView.as_view(url='nursery/', permanent=True)),
+    path('metrics', metrics_view, name='metrics'),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
 
+# Uploaded photos are served by Django during development (only). In production the web
+# server serves MEDIA_ROOT, and should send "Cache-Control: public, max-age=31536000,
+# immutable" for media/variants/, whose file names are content hashes.
+if settings.DEBUG:
+    urlpatterns += [
+        path(settings.MEDIA_URL.lstrip('/') + 'variants/<path:path>', photo_variant, name='photo-variant'),
+    ]
+urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+
 # Add Django site authentication urls (for login, logout, password management)
 urlpatterns += [
     path('accounts/', include('django.contrib.auth.urls')),
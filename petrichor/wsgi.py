@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'petrichor.settings')
 
 application = get_wsgi_application()
+
+# Preload templates, URL resolvers, model metadata and the database driver so
+# the first request on a fresh worker doesn't pay for them (see nursery/warmup.py).
+from nursery.warmup import warm_up_if_enabled
+
+warm_up_if_enabled()